@@ -0,0 +1,183 @@
+from transfer import Transfer
+from message import Message
+from send_queue import SendQueue
+from log import get_logger
+import asyncio
+import socket
+import threading
+
+__all__ = ['AsyncTransfer', 'AsyncServer']
+
+logger = get_logger('async_transfer')
+
+
+class AsyncTransfer(Transfer):
+    """
+        协程模式的数据交互类
+        所有连接共用一个事件循环, 读写均为非阻塞, 消息分发和处理函数与Transfer完全相同
+    """
+    # 事件循环中正在处理消息的连接, 用于block策略下对发送方反压
+    _current = None
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 name=None, legacy=False, queue_size=1024, queue_policy=SendQueue.Drop):
+        self._reader = reader
+        self._writer = writer
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._writable = asyncio.Event()
+        # 因本连接发送队列满而暂停读取的发送方
+        self._blocked = []
+        super().__init__(writer.get_extra_info('socket'), name, legacy, queue_size, queue_policy)
+
+    def run(self):
+        raise RuntimeError('AsyncTransfer must be driven by AsyncServer')
+
+    async def serve(self):
+        """ 协程主循环 """
+        drain_task = self._loop.create_task(self._drain())
+        while not self._be_quit:
+            try:
+                data = await self._reader.read(self.RecvSize)
+            except Exception as e:
+                logger.debug('%s recv error: %s', self.name, e)
+                break
+
+            if not data:
+                break
+            if not self._feed(data):
+                break
+
+        self._on_disconnect()
+        # 关闭发送队列, 等待写协程把剩余的数据发送完
+        self._send_queue.close()
+        try:
+            await asyncio.wait_for(drain_task, self.SendTimeout)
+        except Exception as e:
+            logger.debug('%s drain error: %r', self.name, e)
+        self._release_blocked()
+        self._writer.close()
+        logger.debug('%s----exit', self.name)
+
+    async def _drain(self):
+        """ 写协程, 批量取出发送队列中的数据写入transport """
+        while True:
+            await self._writable.wait()
+            self._writable.clear()
+            items = self._send_queue.pop_all()
+            if items:
+                try:
+                    self._writer.write(b''.join(items))
+                    await self._writer.drain()
+                except Exception as e:
+                    logger.debug('%s send error: %s', self.name, e)
+                    self._send_queue.close()
+            if not self._send_queue.full:
+                self._release_blocked()
+            if self._send_queue.closed and not len(self._send_queue):
+                break
+        if not self._be_quit:
+            # 队列因慢速客户端策略被关闭或发送失败, 断开连接
+            self.ready2exit()
+
+    def _on_queue_ready(self):
+        """ 发送队列由空变为非空, 唤醒写协程 """
+        if self._in_loop():
+            self._writable.set()
+        else:
+            self._loop.call_soon_threadsafe(self._writable.set)
+
+    def _feed(self, data) -> bool:
+        AsyncTransfer._current = self
+        try:
+            return super()._feed(data)
+        finally:
+            AsyncTransfer._current = None
+
+    def _block_sender(self):
+        """ block策略: 事件循环中不能阻塞等待, 改为暂停发送方的读取, 直到本连接的队列有空位 """
+        sender = AsyncTransfer._current
+        if sender and sender is not self and sender not in self._blocked:
+            sender._writer.transport.pause_reading()
+            self._blocked.append(sender)
+
+    def _release_blocked(self):
+        for sender in self._blocked:
+            if not sender._writer.transport.is_closing():
+                sender._writer.transport.resume_reading()
+        self._blocked.clear()
+
+    def _in_loop(self) -> bool:
+        return threading.get_ident() == self._loop_thread
+
+    def ready2exit(self):
+        """ 准备退出 """
+        self._be_quit = True
+        # 在事件循环中调用时, 当前数据处理完后serve会自行退出
+        # 其他线程调用时, 让正在等待的read返回
+        # 接收方太慢被断开时, 直接丢弃未发送的数据
+        close = self._send_queue.overflow and self._writer.transport.abort or self._reader.feed_eof
+        if self._in_loop():
+            close()
+        else:
+            self._loop.call_soon_threadsafe(close)
+
+    def recv_notify(self, msg: Message) -> bool:
+        """
+            接受其他用户发来的消息
+            进程间转发和集群投递在其他线程中调用, 交给事件循环处理, 本连接的状态只在事件循环中修改
+        """
+        if self._in_loop():
+            return super().recv_notify(msg)
+        try:
+            self._loop.call_soon_threadsafe(super().recv_notify, msg)
+        except RuntimeError:
+            # 事件循环已经关闭
+            return False
+        return True
+
+    def send(self, msg: Message):
+        """ 消息发送函数, 只放入发送队列, 由写协程发送 """
+        in_loop = self._in_loop()
+        data = msg.frame_bytes(self._decoder, self._binary)
+        if in_loop and self._send_queue.policy == SendQueue.Block and self._send_queue.full:
+            self._block_sender()
+        # 事件循环中不能阻塞, 其他线程(如离线消息通知)可以阻塞等待
+        if not self._send_queue.put(data, block=not in_loop):
+            if self._send_queue.closed and not self._be_quit:
+                self.ready2exit()
+
+
+class AsyncServer(object):
+    """
+        协程模式服务器, 单个事件循环处理所有客户端连接
+    """
+    def __init__(self, sock: socket.socket, **trans_kwargs):
+        self._sock = sock
+        # 创建AsyncTransfer时的参数
+        self._trans_kwargs = trans_kwargs
+        self._loop = None
+        self._cnt = 0
+
+    def serve_forever(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(
+            asyncio.start_server(self._on_connect, sock=self._sock))
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+            self._loop.close()
+
+    def stop(self):
+        """ 停止事件循环, 可在其他线程或信号处理函数中调用 """
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _on_connect(self, reader, writer):
+        trans = AsyncTransfer(reader, writer, '第' + str(self._cnt) + '个连接',
+                              **self._trans_kwargs)
+        self._cnt += 1
+        await trans.serve()
@@ -0,0 +1,149 @@
+# coding=utf-8
+import argparse
+import contextlib
+import gc
+import io
+import os
+import json
+import random
+import tempfile
+import threading
+import time
+import timeit
+from global_manager import GlobalManger
+from message import *
+from database import FileDatabase
+from user import User, Storable
+import codec
+
+"""
+    服务器内部组件的微基准测试
+    python3 benchmark.py registry --shards 1
+    python3 benchmark.py registry --shards 64
+    python3 benchmark.py message
+    python3 benchmark.py load --users 1000000
+"""
+
+
+class _NullTransfer(object):
+    """ 只接收消息不做任何处理的连接, 用来测量连接表本身的开销 """
+    def recv_notify(self, msg):
+        return True
+
+
+def bench_registry(args):
+    """ 多线程同时向在线用户转发消息, 测试转发吞吐量随线程数的变化 """
+    GlobalManger.ShardCount = args.shards
+    gb = GlobalManger()
+    # 忽略add_connect的输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(args.users):
+            gb.add_connect(str(i), _NullTransfer())
+
+    msg = ChatMsg(ChatMsg.DefaultMsg)
+    ids = [str(random.randrange(args.users)) for _ in range(args.msgs)]
+    print('shards=%d users=%d msgs=%d' % (args.shards, args.users, args.msgs))
+    print('%8s %12s %10s' % ('threads', 'msgs/sec', 'seconds'))
+    for n in args.threads:
+        per = len(ids) // n
+        barrier = threading.Barrier(n + 1)
+
+        def worker(part):
+            barrier.wait()
+            for id_ in part:
+                gb.send_msg2id(id_, msg)
+
+        workers = [threading.Thread(target=worker, args=(ids[i * per:(i + 1) * per],))
+                   for i in range(n)]
+        for t in workers:
+            t.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for t in workers:
+            t.join()
+        cost = time.perf_counter() - start
+        print('%8d %12.0f %10.3f' % (n, per * n / cost, cost))
+
+
+def bench_message(args):
+    """ 消息解析、字段读写和序列化的单条耗时 """
+    print('codec', codec.use(args.codec))
+    chat = json.dumps({'ID': '10000', 'cmd': Message.Cmd.Chat, 'msgid': 0,
+                       'chat': 'hello world', 'friend_id': '10001', 'nick_name': ''})
+
+    def parse():
+        Message.create_msg(chat)
+
+    def dispatch():
+        msg = Message.create_msg(chat)
+        # 模拟_chat_msg中的字段读写
+        to_id = msg.friend_id
+        msg.friend_id = msg.ID
+        msg.nick_name = 'nick'
+        return to_id, msg.cmd, msg.chat
+
+    def serialize():
+        msg = Message.create_msg(chat)
+        msg.nick_name = 'nick'
+        return msg.msg_crypto_bytes
+
+    print('%12s %10s' % ('stage', 'us/msg'))
+    for name, func in (('parse', parse), ('dispatch', dispatch), ('serialize', serialize)):
+        cost = min(timeit.repeat(func, number=args.msgs, repeat=args.repeat))
+        print('%12s %10.2f' % (name, cost / args.msgs * 1e6))
+
+
+def bench_load(args):
+    """ 生成包含users个用户的info.dat, 测试启动时加载用户表的耗时 """
+    print('codec', codec.use(args.codec))
+    users = []
+    for i in range(args.users):
+        ID = str(10000 + i)
+        users.append((ID, User(ID=ID, nick_name='user%d' % i, sex='M', birthday='2000-01-01',
+                               desc='', allow_find=True, ext_info={},
+                               groups={'friends': [str(10000 + (i + j) % args.users) for j in range(1, 6)]})))
+    with tempfile.TemporaryDirectory() as base_dir:
+        path = os.path.join(base_dir, FileDatabase.INFO_DB_NAME)
+        with open(path, 'w', encoding='utf-8') as f:
+            FileDatabase._dump_users(users, f)
+        del users
+        print('users=%d size=%.1fMB' % (args.users, os.path.getsize(path) / 1024 / 1024))
+        for _ in range(args.repeat):
+            gc.collect()
+            start = time.perf_counter()
+            data = FileDatabase._get_data(base_dir, FileDatabase.INFO_DB_NAME, decode=Storable.decode)
+            cost = time.perf_counter() - start
+            assert len(data) == args.users
+            del data
+            print('load %.3f s  %.0f users/sec' % (cost, args.users / cost))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SimpleChatServer benchmark')
+    sub = parser.add_subparsers(dest='bench')
+    sub.required = True
+
+    registry = sub.add_parser('registry', help='GlobalManger消息转发吞吐量')
+    registry.add_argument('--shards', type=int, default=GlobalManger.ShardCount)
+    registry.add_argument('--users', type=int, default=10000)
+    registry.add_argument('--msgs', type=int, default=400000)
+    registry.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    registry.set_defaults(func=bench_registry)
+
+    message = sub.add_parser('message', help='消息解析/读写/序列化耗时')
+    message.add_argument('--msgs', type=int, default=100000)
+    message.add_argument('--repeat', type=int, default=5)
+    message.add_argument('--codec', choices=['auto'] + [c.name for c in codec.Codecs], default='json')
+    message.set_defaults(func=bench_message)
+
+    load = sub.add_parser('load', help='启动时加载用户表的耗时')
+    load.add_argument('--users', type=int, default=1000000)
+    load.add_argument('--repeat', type=int, default=3)
+    load.add_argument('--codec', choices=['auto'] + [c.name for c in codec.Codecs], default='json')
+    load.set_defaults(func=bench_load)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,123 @@
+import codec
+
+__all__ = ['BinaryProto']
+
+
+class BinaryProto(object):
+    """
+        二进制消息编码, 与JSON消息一一对应
+        消息格式: 1字节标记0x00 + 若干字段
+        字段格式: varint(tag << 3 | kind) + 值
+            KindInt     zigzag编码的varint
+            KindFalse   无值
+            KindTrue    无值
+            KindStr     varint长度 + utf-8字节, 聊天内容直接以原始字节存放
+            KindJson    varint长度 + JSON, 用于字典和列表等嵌套字段
+            KindNull    无值
+        tag由Message的字段类型表生成, 字段只能追加不能调整顺序
+        JSON消息总是以'{'开头, 收到的第一个字节就能区分两种编码
+    """
+    Magic = 0
+    KindInt = 0
+    KindFalse = 1
+    KindTrue = 2
+    KindStr = 3
+    KindJson = 4
+    KindNull = 5
+
+    def __init__(self, tags: dict):
+        self._tags = tags
+        self._names = {tag: name for name, tag in tags.items()}
+
+    @classmethod
+    def is_binary(cls, data) -> bool:
+        return len(data) > 0 and data[0] == cls.Magic
+
+    def dumps(self, msg_dict: dict) -> bytes:
+        """ 将消息字典编码为二进制 """
+        out = bytearray()
+        out.append(self.Magic)
+        for name, value in msg_dict.items():
+            tag = self._tags.get(name)
+            if tag is None:
+                raise ValueError('unknown field %s' % name)
+            tag <<= 3
+            if value is None:
+                self._put_varint(out, tag | self.KindNull)
+            elif value is True or value is False:
+                self._put_varint(out, tag | (value and self.KindTrue or self.KindFalse))
+            elif isinstance(value, int):
+                self._put_varint(out, tag | self.KindInt)
+                # zigzag, 负数也只占很少的字节
+                self._put_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+            elif isinstance(value, str):
+                data = value.encode('utf-8')
+                self._put_varint(out, tag | self.KindStr)
+                self._put_varint(out, len(data))
+                out += data
+            else:
+                data = codec.dumpb(value)
+                self._put_varint(out, tag | self.KindJson)
+                self._put_varint(out, len(data))
+                out += data
+        return bytes(out)
+
+    def loads(self, data) -> dict:
+        """ 将二进制消息解码为字典, 格式错误时抛出ValueError """
+        if not self.is_binary(data):
+            raise ValueError('not a binary message')
+        view = memoryview(data)
+        end = len(view)
+        pos = 1
+        msg_dict = {}
+        try:
+            while pos < end:
+                header, pos = self._get_varint(view, pos)
+                name = self._names.get(header >> 3)
+                if name is None:
+                    raise ValueError('unknown field tag %d' % (header >> 3))
+                kind = header & 7
+                if kind == self.KindInt:
+                    value, pos = self._get_varint(view, pos)
+                    value = value >> 1 if not value & 1 else -((value + 1) >> 1)
+                elif kind == self.KindFalse:
+                    value = False
+                elif kind == self.KindTrue:
+                    value = True
+                elif kind == self.KindNull:
+                    value = None
+                elif kind == self.KindStr or kind == self.KindJson:
+                    length, pos = self._get_varint(view, pos)
+                    if pos + length > end:
+                        raise ValueError('field %s truncated' % name)
+                    raw = view[pos:pos + length]
+                    pos += length
+                    value = str(raw, 'utf-8') if kind == self.KindStr else codec.loads(raw)
+                else:
+                    raise ValueError('unknown field kind %d' % kind)
+                msg_dict[name] = value
+        except IndexError:
+            raise ValueError('message truncated')
+        return msg_dict
+
+    @staticmethod
+    def _put_varint(out: bytearray, value: int):
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def _get_varint(view, pos):
+        result = 0
+        shift = 0
+        while True:
+            b = view[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result, pos
+            shift += 7
+            # 64位整数最多10个字节, 防止超长的输入构造出巨大的整数
+            if shift > 63:
+                raise ValueError('varint too long')
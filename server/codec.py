@@ -0,0 +1,98 @@
+from user import Storable
+import json
+
+"""
+    JSON编解码
+    网络消息和数据库文件都通过本模块的dumps/loads读写
+    启动时调用use选择实现, 安装了orjson时auto会使用orjson
+    使用方式: import codec; codec.dumps(obj)
+"""
+
+__all__ = ['JsonCodec', 'OrjsonCodec', 'Codecs', 'use']
+
+
+class JsonCodec(object):
+    """ 标准库json, 使用紧凑分隔符, 编码器和解码器只创建一次 """
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False,
+                                         default=Storable.encode)
+        self._decoders = {None: json.JSONDecoder()}
+
+    def dumps(self, obj) -> str:
+        return self._encoder.encode(obj)
+
+    def dumpb(self, obj) -> bytes:
+        return self._encoder.encode(obj).encode('utf-8')
+
+    def loads(self, s, obj_hook=None):
+        """ s可以是str或utf-8编码的bytes, obj_hook对每个解析出的字典调用 """
+        if not isinstance(s, str):
+            s = bytes(s).decode('utf-8')
+        decoder = self._decoders.get(obj_hook)
+        if decoder is None:
+            decoder = self._decoders[obj_hook] = json.JSONDecoder(object_hook=obj_hook)
+        return decoder.decode(s)
+
+
+class OrjsonCodec(object):
+    """ orjson, 输出本身就是紧凑的utf-8 bytes """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj) -> str:
+        return self.dumpb(obj).decode('utf-8')
+
+    def dumpb(self, obj) -> bytes:
+        return self._orjson.dumps(obj, default=Storable.encode)
+
+    def loads(self, s, obj_hook=None):
+        obj = self._orjson.loads(s)
+        if obj_hook is not None:
+            obj = self._apply_hook(obj, obj_hook)
+        return obj
+
+    @classmethod
+    def _apply_hook(cls, obj, obj_hook):
+        """ orjson不支持object_hook, 解析后由内向外对每个字典调用 """
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                if isinstance(v, (dict, list)):
+                    obj[k] = cls._apply_hook(v, obj_hook)
+            return obj_hook(obj)
+        if isinstance(obj, list):
+            for i, v in enumerate(obj):
+                if isinstance(v, (dict, list)):
+                    obj[i] = cls._apply_hook(v, obj_hook)
+        return obj
+
+
+# 按优先级排列, auto选择第一个可用的实现
+Codecs = (OrjsonCodec, JsonCodec)
+
+current = JsonCodec()
+dumps = current.dumps
+dumpb = current.dumpb
+loads = current.loads
+
+
+def use(name='auto'):
+    """ 选择编解码实现, 在启动时调用, 返回实际使用的名字 """
+    global current, dumps, dumpb, loads
+    for cls in Codecs:
+        if name not in ('auto', cls.name):
+            continue
+        try:
+            current = cls()
+            break
+        except ImportError:
+            if name != 'auto':
+                raise
+    dumps = current.dumps
+    dumpb = current.dumpb
+    loads = current.loads
+    return current.name
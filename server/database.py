@@ -1,15 +1,28 @@
 from multiprocessing import Lock
-from threading import Timer
+from threading import Lock as ThreadLock, RLock, Timer
+from contextlib import contextmanager
+from search_index import NGramIndex
 from user import *
 from utils import use_log
-import json
+from log import get_logger
+from wal import WriteAheadLog
+import codec
+import gc
+import itertools
 import os
+import queue
 import shutil
+import sqlite3
+import time
 
 __all__ = ['Database']
 
+logger = get_logger('database')
+
 
 class Database(object):
+    # 多个进程能否同时使用同一个数据库
+    Shared = False
 
     def __init__(self):
         raise Exception('please use Database.create_db')
@@ -17,21 +30,50 @@ class Database(object):
     def query_user_pwd(self, user_id: str, pwd: str) -> bool:
         pass
 
+    def check_user_pwd(self, user_id: str, pwd: str) -> bool:
+        pass
+
+    def modify_pwd(self, user_id, old_pwd, new_pwd) -> bool:
+        pass
+
     def query_user(self, user_id: str):
         pass
 
+    def query_users(self, user_ids) -> dict:
+        pass
+
+    def find_user4id(self, user_id: str, fuzzy=False, limit=None, offset=0, findable=False) -> list:
+        """ findable为True时只返回允许被查找的用户, 在计算offset和limit之前过滤 """
+        pass
+
+    def find_user4nickname(self, nick_name, fuzzy=False, limit=None, offset=0, findable=False) -> list:
+        pass
+
     def add_user(self, user: User, pwd: str):
         pass
 
     def close(self):
         pass
 
-    def data_changed(self):
+    def data_changed(self, user: User=None):
+        pass
+
+    def update_user_profile(self, user: User, **profile):
         pass
 
     def distribution_id(self):
         pass
 
+    def last_sync_time(self):
+        """ 最后一次数据写入磁盘的时间戳, 没有定期同步的数据库返回None """
+        return None
+
+    @staticmethod
+    def _check_profile(profile: dict):
+        for key in profile:
+            if key not in User.ProfileKeys:
+                raise AttributeError('%s is not a profile attribute' % key)
+
     def _storage(self):
         pass
 
@@ -40,12 +82,16 @@ class Database(object):
 
     @staticmethod
     def create_db(sql_url=None, file_path=None):
-        db = None
+        """
+            指定sql_url时创建SQL数据库, 地址错误或无法打开时抛出异常, 不会改用文件数据库
+            不指定时返回已经创建的SQL数据库, 没有则使用文件数据库
+        """
+        if sql_url:
+            return SQLDatabase(sql_url)
         try:
-            db = SQLDatabase(sql_url)
-        except Exception as e:
-            db = FileDatabase(file_path)
-        return db
+            return SQLDatabase()
+        except Exception:
+            return FileDatabase(file_path)
 
 
 class FileDatabase(Database):
@@ -59,6 +105,9 @@ class FileDatabase(Database):
     PWD_DB_NAME = 'pwd.dat'
     INFO_DB_NAME = 'info.dat'
     DIST_DB_NAME = 'dist.dat'
+    WAL_NAME = 'wal.log'
+    # 每次预留的ID数量, 磁盘上只记录已预留的最大ID
+    IdBlockSize = 1000
 
     def __new__(cls, *args, **kwargs):
         if not cls.__instance:
@@ -73,13 +122,19 @@ class FileDatabase(Database):
             self._user_pwd_table = {}
             self._user_info_table = {}
             self._nick_table = {}
+            # 模糊查找用的子串索引, key都是用户ID
+            self._id_index = NGramIndex()
+            self._nick_index = NGramIndex()
             self._base_dir = base_dir and base_dir or './database'
-            self._pwd_file = None
-            self._info_file = None
-            self._dist_file = None
+            # 已预留ID的上限(不含), 持久化到磁盘
             self._dist_id = 10000
+            self._ids = None
             self._sync_exit = False
             self._timer = None
+            self._wal = None
+            # 同一时间只进行一次快照
+            self._snapshot_l = ThreadLock()
+            self._last_sync = None
             self._load()
             self._l.release()
             # 释放锁，防止死锁
@@ -91,9 +146,12 @@ class FileDatabase(Database):
     def close(self):
         self._timer.cancel()
         self._disk_sync()
+        self._wal.close()
         self._user_pwd_table.clear()
         self._user_info_table.clear()
         self._nick_table.clear()
+        self._id_index = NGramIndex()
+        self._nick_index = NGramIndex()
 
     def check_user_pwd(self, user_id: str, pwd: str) -> bool:
         """ 检查用户名和密码 """
@@ -103,7 +161,11 @@ class FileDatabase(Database):
 
     def modify_pwd(self, user_id, old_pwd, new_pwd) -> bool:
         if self.check_user_pwd(user_id, old_pwd):
+            self._l.acquire()
             self._user_pwd_table[user_id] = new_pwd
+            self._wal.append({'op': 'pwd', 'id': user_id, 'pwd': new_pwd})
+            self._changed = True
+            self._l.release()
             return True
         return False
 
@@ -111,132 +173,258 @@ class FileDatabase(Database):
         """ 查询用户信息 """
         return self._user_info_table.get(user_id)
 
-    def find_user4id(self, user_id: str, fuzzy=False) -> list:
+    def query_users(self, user_ids) -> dict:
+        """ 批量查询用户信息, 返回 {ID: 用户}, 不存在的ID不在结果中 """
+        table = self._user_info_table
+        users = {}
+        for user_id in user_ids:
+            user = table.get(user_id)
+            if user:
+                users[user_id] = user
+        return users
+
+    def find_user4id(self, user_id: str, fuzzy=False, limit=None, offset=0, findable=False) -> list:
         """ 查找好友 """
         if not fuzzy:
             user = self._user_info_table.get(user_id)
-            return user and [user] or []
-        else:
-            result = []
-            for key in self._user_info_table.keys():
-                if user_id in key:
-                    result.append(self._user_info_table.get(key))
-            return result
+            return user and (not findable or user.allow_find) and [user] or []
+        ids = self._id_index.search(user_id, limit, offset, findable and self._findable or None)
+        return self._ids2users(ids)
 
-    def find_user4nickname(self, nick_name, fuzzy=False) -> list:
+    def find_user4nickname(self, nick_name, fuzzy=False, limit=None, offset=0, findable=False) -> list:
         """ 使用昵称查询用户 """
         if not fuzzy:
             users = self._nick_table.get(nick_name)
-            return users and users or []
-        else:
-            result = []
-            for key in self._nick_table.keys():
-                if nick_name in key:
-                    result.extend(self._nick_table.get(nick_name))
-            return result
+            if not users:
+                return []
+            # 按注册顺序保存, 分页顺序稳定
+            users = (user for user in list(users.values()) if not findable or user.allow_find)
+            return list(itertools.islice(users, offset, None if limit is None else offset + limit))
+        ids = self._nick_index.search(nick_name, limit, offset, findable and self._findable or None)
+        return self._ids2users(ids)
+
+    def _findable(self, id_) -> bool:
+        user = self._user_info_table.get(id_)
+        return bool(user and user.allow_find)
+
+    def _ids2users(self, ids: list) -> list:
+        users = (self._user_info_table.get(id_) for id_ in ids)
+        return [user for user in users if user]
 
     def add_user(self, user: User, pwd: str):
         """ 添加一个用户, 添加前请查询用户是否存在，该方法不予检查 """
         self._l.acquire()
         self._user_info_table[user.ID] = user
         self._user_pwd_table[user.ID] = pwd
-        self._add_user2nick_table(user)
+        self._add_user2index(user)
+        self._wal.append({'op': 'user', 'user': user})
+        self._wal.append({'op': 'pwd', 'id': user.ID, 'pwd': pwd})
         self._changed = True
         self._l.release()
-        print('DB add user --> %s' % user)
+        logger.debug('DB add user --> %s', user)
 
-    def data_changed(self):
-        """ 设置数据更新 """
+    def data_changed(self, user: User=None):
+        """ 设置数据更新, 传入修改过的用户时将其写入预写日志 """
         self._l.acquire()
+        if user:
+            self._wal.append({'op': 'user', 'user': user})
         self._changed = True
         self._l.release()
 
-    def distribution_id(self):
-        ret = None
+    def update_user_profile(self, user: User, **profile):
+        """ 修改用户资料, 昵称改变时同步更新昵称索引 """
+        self._check_profile(profile)
         self._l.acquire()
-        ret = self._dist_id
-        self._dist_id += 1
-        # 同步写入文件
-        self._dist_file.truncate(0)
-        self._dist_file.seek(0)
-        json.dump(self._dist_id, self._dist_file)
-        self._dist_file.flush()
+        old_nick = user.nick_name
+        for key, value in profile.items():
+            setattr(user, key, value)
+        if user.nick_name != old_nick:
+            self._move_nick(user, old_nick)
+        self._wal.append({'op': 'user', 'user': user})
+        self._changed = True
         self._l.release()
+
+    def distribution_id(self):
+        """ 从内存中分配ID, 当前块用完时才加锁预留下一块 """
+        # itertools.count的next是原子操作, 多线程分配不会重复
+        ret = next(self._ids)
+        if ret >= self._dist_id:
+            self._reserve_ids(ret)
         return str(ret)
 
-    @use_log
-    def _disk_sync(self):
-        """ 同步信息到磁盘 """
+    def _reserve_ids(self, id_):
+        """ 预留从id_开始的一块ID, 先写入预写日志再分配, 崩溃后不会重复分配 """
         self._l.acquire()
-        if self._changed:
-            self._storage()
-        self._changed = False
+        # 其他线程可能已经预留了更大的块
+        if id_ >= self._dist_id:
+            dist_id = id_ + self.IdBlockSize
+            # distribution_id不加锁读取_dist_id, 必须在记录写入磁盘之后再更新
+            self._wal.append({'op': 'dist', 'id': dist_id}, fsync=True)
+            self._dist_id = dist_id
+            self._changed = True
         self._l.release()
 
-    def _storage(self):
-        """ 将文件信息写入磁盘 """
-        self._pwd_file.truncate(0)
-        self._info_file.truncate(0)
-        self._dist_file.truncate(0)
-        self._pwd_file.seek(0)
-        self._info_file.seek(0)
-        self._dist_file.seek(0)
-        json.dump(self._dist_id, self._dist_file)
-        json.dump(self._user_pwd_table, self._pwd_file)
-        json.dump(self._user_info_table, self._info_file, default=Storable.encode)
-        self._info_file.flush()
-        self._pwd_file.flush()
-        self._dist_file.flush()
+    @use_log
+    def _disk_sync(self):
+        """ 同步信息到磁盘, 只在获取时间点视图时持有锁, 序列化和写盘不阻塞其他操作 """
+        with self._snapshot_l:
+            self._l.acquire()
+            if not self._changed:
+                self._l.release()
+                # 没有修改, 磁盘上的数据就是最新的
+                self._last_sync = time.time()
+                return
+            # 时间点视图只复制字典中的引用, 同时切换预写日志
+            # 之后的修改写入新日志, 启动时在快照之上重放
+            users = list(self._user_info_table.items())
+            pwds = dict(self._user_pwd_table)
+            dist_id = self._dist_id
+            self._wal.rotate()
+            self._changed = False
+            self._l.release()
+            try:
+                self._storage(users, pwds, dist_id)
+            except Exception:
+                self.data_changed()
+                raise
+            self._wal.drop_rotated()
+            self._last_sync = time.time()
+
+    def last_sync_time(self):
+        return self._last_sync
+
+    def _storage(self, users: list, pwds: dict, dist_id: int):
+        """ 将快照写入磁盘, 先写临时文件再替换, 原来的快照保存为.bak """
+        self._write_snapshot(self.DIST_DB_NAME, lambda f: f.write(codec.dumps(dist_id)))
+        self._write_snapshot(self.PWD_DB_NAME, lambda f: f.write(codec.dumps(pwds)))
+        self._write_snapshot(self.INFO_DB_NAME, lambda f: self._dump_users(users, f))
+
+    def _write_snapshot(self, name, dump):
+        path = os.path.join(self._base_dir, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            dump(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path) and os.path.getsize(path):
+            # 硬链接保留原快照作为备份, 替换过程中主文件始终存在
+            bak_path = path + '.bak'
+            try:
+                os.link(path, bak_path + '.tmp')
+                os.replace(bak_path + '.tmp', bak_path)
+            except OSError:
+                shutil.copyfile(path, bak_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _dump_users(users: list, f):
+        """ 逐个序列化用户写入文件, 不需要在内存中生成整个JSON字符串 """
+        f.write('{')
+        for i, (user_id, user) in enumerate(users):
+            if i:
+                f.write(', ')
+            f.write(codec.dumps(user_id))
+            f.write(': ')
+            f.write(FileDatabase._encode_user(user))
+        f.write('}')
+
+    @staticmethod
+    def _encode_user(user, retry=3):
+        """ 序列化时不持有锁, 用户数据正在被修改时重试 """
+        for _ in range(retry):
+            try:
+                return codec.dumps(user)
+            except RuntimeError:
+                # dictionary changed size during iteration
+                continue
+        return codec.dumps(user)
+
+    def _add_user2index(self, user):
+        """ 添加一个用户到昵称表和子串索引 """
+        self._add_user2nick_table(user)
+        self._id_index.add(user.ID, user.ID)
+        self._nick_index.add(user.ID, user.nick_name)
 
     def _add_user2nick_table(self, user):
-        """ 添加一个用户到昵称索引表 """
-        if not self._nick_table.get(user.nick_name):
-            self._nick_table[user.nick_name] = []
-        self._nick_table[user.nick_name].append(user)
+        """ 昵称表的每个桶以ID为键, 添加和删除都是O(1) """
+        users = self._nick_table.get(user.nick_name)
+        if users is None:
+            users = self._nick_table[user.nick_name] = {}
+        users[user.ID] = user
+
+    def _move_nick(self, user, old_nick):
+        """ 用户修改昵称后从原来的桶移到新桶, 调用者需持有锁 """
+        users = self._nick_table.get(old_nick)
+        if users is not None:
+            users.pop(user.ID, None)
+            if not users:
+                del self._nick_table[old_nick]
+        self._add_user2nick_table(user)
+        self._nick_index.add(user.ID, user.nick_name)
 
     def _load(self):
         """ 从文件加载数据 """
-        self._user_info_table, self._info_file = \
-            self._get_data(self._base_dir, self.INFO_DB_NAME, obj_hook=Storable.decode)
-        self._user_pwd_table, self._pwd_file = \
-            self._get_data(self._base_dir, self.PWD_DB_NAME)
-        self._dist_id, self._dist_file = \
-            self._get_data(self._base_dir, self.DIST_DB_NAME)
+        self._user_info_table = self._get_data(self._base_dir, self.INFO_DB_NAME, decode=Storable.decode)
+        self._user_pwd_table = self._get_data(self._base_dir, self.PWD_DB_NAME)
+        self._dist_id = self._get_data(self._base_dir, self.DIST_DB_NAME)
+        # 重放上次快照之后的修改
+        wal_path = os.path.join(self._base_dir, self.WAL_NAME)
+        for record in WriteAheadLog.replay(wal_path):
+            self._redo(record)
+        self._wal = WriteAheadLog(wal_path)
+        # 上次预留而没有分配的ID直接跳过, 从已预留的上限开始分配
+        self._ids = itertools.count(self._dist_id)
         self._changed = True
-        # 缓存以昵称为索引表，加快用昵称查询的好友查找
+        # 缓存以昵称为索引表和子串索引，加快查找好友
         for user in self._user_info_table.values():
-            self._add_user2nick_table(user)
+            self._add_user2index(user)
+
+    def _redo(self, record: dict):
+        """ 重放一条预写日志记录 """
+        op = record.get('op')
+        if op == 'user':
+            user = Storable.decode(record['user'])
+            self._user_info_table[user.ID] = user
+        elif op == 'pwd':
+            self._user_pwd_table[record['id']] = record['pwd']
+        elif op == 'dist':
+            self._dist_id = max(self._dist_id, record['id'])
 
     def __sync_backup_disk(self):
-        """ 同步和备份数据 """
-        pwd_path = os.path.join(self._base_dir, self.PWD_DB_NAME)
-        pwd_bak_path = os.path.join(self._base_dir, self.PWD_DB_NAME+'.bak')
-        info_path = os.path.join(self._base_dir, self.INFO_DB_NAME)
-        info_bak_path = os.path.join(self._base_dir, self.INFO_DB_NAME+'.bak')
-        dist_path = os.path.join(self._base_dir, self.DIST_DB_NAME)
-        dist_bak_path = os.path.join(self._base_dir, self.DIST_DB_NAME+'.bak')
-
-        self._disk_sync()
-        self._l.acquire()
-        shutil.copyfile(pwd_path, pwd_bak_path)
-        shutil.copyfile(info_path, info_bak_path)
-        shutil.copyfile(dist_path, dist_bak_path)
-        self._l.release()
-
-        self._timer = Timer(600, self.__sync_backup_disk)
-        self._timer.start()
+        """ 同步和备份数据, 在定时器线程中执行 """
+        try:
+            self._disk_sync()
+        except Exception:
+            logger.exception('sync database error')
+        finally:
+            # 本次失败也要继续定时同步
+            self._timer = Timer(600, self.__sync_backup_disk)
+            self._timer.start()
 
     @classmethod
-    def _get_data(cls, base_dir, dbname, obj_hook=None):
-        """ 从文件获取信息 """
-        data, file = cls._load_db(base_dir, dbname, obj_hook=obj_hook)
+    def _get_data(cls, base_dir, dbname, decode=None):
+        """
+            从文件获取信息, decode只对顶层字典的每个值调用
+            嵌套的字典(如用户的ext_info)来自客户端, 不能被还原成对象
+        """
+        # 一次创建大量对象时暂停循环垃圾回收, 避免反复扫描刚加载的用户表
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            data, file = cls._load_db(base_dir, dbname)
+            if data and decode:
+                data = {key: decode(value) for key, value in data.items()}
+        finally:
+            if gc_enabled:
+                gc.enable()
+        file.close()
         if not data:
             """ 新建的数据文件 """
             if dbname == cls.PWD_DB_NAME or dbname == cls.INFO_DB_NAME:
                 data = {}
             elif dbname == cls.DIST_DB_NAME:
                 data = 10000
-        return data, file
+        return data
 
     @staticmethod
     def _load_db(base_dir, dbname, obj_hook=None):
@@ -245,10 +433,10 @@ class FileDatabase(Database):
         if is_new:
             return None, file
         try:
-            data = json.load(file, object_hook=obj_hook)
+            data = codec.loads(file.read(), obj_hook)
             return data, file
-        except json.JSONDecodeError as e:
-            print(e)
+        except ValueError as e:
+            logger.error('load %s error: %s', dbname, e)
             # 备份文件读取失败，抛出异常
             if dbname.endswith('bak'):
                 raise IOError('DB read error, please fix it')
@@ -261,16 +449,203 @@ class FileDatabase(Database):
         is_new = False
         path = os.path.join(base_dir, name)
         if not os.path.exists(path):
-            file = open(path, 'w+')
+            file = open(path, 'w+', encoding='utf-8')
             is_new = True
         else:
-            file = open(path, 'r+')
+            file = open(path, 'r+', encoding='utf-8')
         return file, is_new
 
 
 class SQLDatabase(Database):
     """
-        使用SQL数据库持久化
+        使用SQL数据库持久化, 基于sqlite3
+        sql_url格式: sqlite:///path/to/chat.db
+        使用有上限的连接池, 每次操作取出一个连接, 用完放回, 开启WAL模式, 读写可以并发
+        线程模式下连接数不随客户端线程增长
     """
-    def __init__(self, sql_url):
-        raise Exception('use FileDatabase')
+    _l = RLock()
+    __instance = None
+    __inited = False
+    Shared = True
+    # 连接池中最多的连接数, 全部被占用时等待其他线程放回
+    PoolSize = 8
+
+    _CreateSQL = (
+        'CREATE TABLE IF NOT EXISTS users ('
+        'ID TEXT PRIMARY KEY, pwd TEXT NOT NULL, nick_name TEXT, sex TEXT, birthday TEXT, '
+        '"desc" TEXT, allow_find INTEGER, ext_info TEXT, groups TEXT)',
+        'CREATE INDEX IF NOT EXISTS users_nick_name ON users (nick_name)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+        "INSERT OR IGNORE INTO meta (key, value) VALUES ('dist_id', 10000)",
+    )
+    _UserColumns = 'ID, nick_name, sex, birthday, "desc", allow_find, ext_info, groups'
+    _QueryUserSQL = 'SELECT %s FROM users WHERE ID = ?' % _UserColumns
+    _QueryUsersSQL = 'SELECT %s FROM users WHERE ID IN (%%s)' % _UserColumns
+    # 批量查询时每条语句最多包含的ID数量, 不超过SQLite的参数个数限制
+    QueryBatch = 500
+    # 查找语句中的%%s替换为空或_FindableSQL, 按ID排序保证分页稳定
+    _FindIdSQL = "SELECT %s FROM users WHERE ID LIKE ? ESCAPE '\\' %%s ORDER BY ID LIMIT ? OFFSET ?" % _UserColumns
+    _FindNickSQL = 'SELECT %s FROM users WHERE nick_name = ? %%s ORDER BY ID LIMIT ? OFFSET ?' % _UserColumns
+    _FindNickFuzzySQL = ("SELECT %s FROM users WHERE nick_name LIKE ? ESCAPE '\\' %%s ORDER BY ID LIMIT ? OFFSET ?"
+                         % _UserColumns)
+    _FindableSQL = 'AND allow_find'
+    _AddUserSQL = ('INSERT INTO users (ID, pwd, nick_name, sex, birthday, "desc", allow_find, ext_info, groups) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+    _UpdateUserSQL = ('UPDATE users SET nick_name = ?, sex = ?, birthday = ?, "desc" = ?, '
+                      'allow_find = ?, ext_info = ?, groups = ? WHERE ID = ?')
+    _CheckPwdSQL = 'SELECT 1 FROM users WHERE ID = ? AND pwd = ?'
+    _ModifyPwdSQL = 'UPDATE users SET pwd = ? WHERE ID = ? AND pwd = ?'
+    # 不使用RETURNING(需要SQLite 3.35), 在同一个写事务中先加一再读取
+    _IncDistIdSQL = "UPDATE meta SET value = value + 1 WHERE key = 'dist_id'"
+    _DistIdSQL = "SELECT value - 1 FROM meta WHERE key = 'dist_id'"
+
+    def __new__(cls, *args, **kwargs):
+        if not cls.__instance:
+            cls.__instance = super().__new__(cls)
+        return cls.__instance
+
+    def __init__(self, sql_url=None):
+        with self._l:
+            if self.__inited:
+                return
+            if not sql_url:
+                raise Exception('use FileDatabase')
+            self._path = self._parse_url(sql_url)
+            self._pool = queue.LifoQueue()
+            self._conns = []
+            with self._conn() as conn, conn:
+                for sql in self._CreateSQL:
+                    conn.execute(sql)
+            self.__inited = True
+
+    @staticmethod
+    def _parse_url(sql_url: str) -> str:
+        prefix = 'sqlite:///'
+        if not sql_url.startswith(prefix):
+            raise ValueError('unsupported sql url %s' % sql_url)
+        return sql_url[len(prefix):]
+
+    @contextmanager
+    def _conn(self):
+        """ 从连接池取出一个连接, 退出with时放回, 连接数没有达到上限时创建新连接 """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._l:
+                if len(self._conns) < self.PoolSize:
+                    conn = sqlite3.connect(self._path, timeout=10, check_same_thread=False,
+                                           cached_statements=64)
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.execute('PRAGMA synchronous=NORMAL')
+                    self._conns.append(conn)
+            if conn is None:
+                conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @use_log
+    def close(self):
+        with self._l:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+            self._pool = queue.LifoQueue()
+
+    def check_user_pwd(self, user_id: str, pwd: str) -> bool:
+        """ 检查用户名和密码 """
+        with self._conn() as conn:
+            return conn.execute(self._CheckPwdSQL, (user_id, pwd)).fetchone() is not None
+
+    def modify_pwd(self, user_id, old_pwd, new_pwd) -> bool:
+        with self._conn() as conn, conn:
+            return conn.execute(self._ModifyPwdSQL, (new_pwd, user_id, old_pwd)).rowcount == 1
+
+    def query_user(self, user_id: str):
+        """ 查询用户信息 """
+        with self._conn() as conn:
+            row = conn.execute(self._QueryUserSQL, (user_id,)).fetchone()
+        return row and self._row2user(row) or None
+
+    def query_users(self, user_ids) -> dict:
+        """ 批量查询用户信息, 每QueryBatch个ID一条语句 """
+        user_ids = list(user_ids)
+        users = {}
+        with self._conn() as conn:
+            for i in range(0, len(user_ids), self.QueryBatch):
+                batch = user_ids[i:i + self.QueryBatch]
+                sql = self._QueryUsersSQL % ', '.join('?' * len(batch))
+                for row in conn.execute(sql, batch):
+                    user = self._row2user(row)
+                    users[user.ID] = user
+        return users
+
+    def find_user4id(self, user_id: str, fuzzy=False, limit=None, offset=0, findable=False) -> list:
+        """ 查找好友 """
+        if not fuzzy:
+            user = self.query_user(user_id)
+            return user and (not findable or user.allow_find) and [user] or []
+        # LIMIT -1 表示不限制数量
+        limit = -1 if limit is None else limit
+        sql = self._FindIdSQL % (findable and self._FindableSQL or '')
+        with self._conn() as conn:
+            rows = conn.execute(sql, (self._like(user_id), limit, offset)).fetchall()
+        return [self._row2user(row) for row in rows]
+
+    def find_user4nickname(self, nick_name, fuzzy=False, limit=None, offset=0, findable=False) -> list:
+        """ 使用昵称查询用户 """
+        limit = -1 if limit is None else limit
+        cond = findable and self._FindableSQL or ''
+        with self._conn() as conn:
+            if not fuzzy:
+                rows = conn.execute(self._FindNickSQL % cond, (nick_name, limit, offset)).fetchall()
+            else:
+                rows = conn.execute(self._FindNickFuzzySQL % cond, (self._like(nick_name), limit, offset)).fetchall()
+        return [self._row2user(row) for row in rows]
+
+    def add_user(self, user: User, pwd: str):
+        """ 添加一个用户, 添加前请查询用户是否存在，该方法不予检查 """
+        with self._conn() as conn, conn:
+            conn.execute(self._AddUserSQL, (user.ID, pwd) + self._user_values(user))
+        logger.debug('DB add user --> %s', user)
+
+    def data_changed(self, user: User=None):
+        """ 将修改过的用户写入数据库 """
+        if not user:
+            return
+        with self._conn() as conn, conn:
+            conn.execute(self._UpdateUserSQL, self._user_values(user) + (user.ID,))
+
+    def update_user_profile(self, user: User, **profile):
+        """ 修改用户资料, 昵称索引由数据库维护 """
+        self._check_profile(profile)
+        for key, value in profile.items():
+            setattr(user, key, value)
+        self.data_changed(user)
+
+    def distribution_id(self):
+        with self._conn() as conn, conn:
+            # 开始时就获取写锁, 其他连接不能在UPDATE和SELECT之间修改
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(self._IncDistIdSQL)
+            return str(conn.execute(self._DistIdSQL).fetchone()[0])
+
+    @staticmethod
+    def _like(s: str) -> str:
+        """ 转义LIKE中的通配符 """
+        s = s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return '%' + s + '%'
+
+    @staticmethod
+    def _user_values(user: User) -> tuple:
+        return (user.nick_name, user.sex, user.birthday, user.desc,
+                user.allow_find, codec.dumps(user.ext_info), codec.dumps(user.groups))
+
+    @staticmethod
+    def _row2user(row) -> User:
+        ID, nick_name, sex, birthday, desc, allow_find, ext_info, groups = row
+        return User(ID=ID, nick_name=nick_name, sex=sex, birthday=birthday, desc=desc,
+                    allow_find=None if allow_find is None else bool(allow_find),
+                    ext_info=codec.loads(ext_info), groups=codec.loads(groups))
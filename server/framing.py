@@ -0,0 +1,64 @@
+import struct
+
+__all__ = ['FrameDecoder', 'LegacyDecoder', 'create_decoder']
+
+
+class FrameDecoder(object):
+    """
+        长度前缀分帧
+        每条消息格式为 4字节大端无符号长度 + 消息体
+        feed可以一次解析出任意条完整消息，不完整的部分留在缓冲区等待下次数据
+    """
+    Header = struct.Struct('!I')
+    MaxFrame = 16 * 1024 * 1024
+
+    def __init__(self):
+        # 接收缓冲区复用, 只在每次feed结束时丢弃已解析的部分
+        self._buf = bytearray()
+
+    def feed(self, data) -> list:
+        """ 追加收到的数据, 返回所有完整消息体 """
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        hsize = self.Header.size
+        end = len(buf)
+        while end - pos >= hsize:
+            length, = self.Header.unpack_from(buf, pos)
+            if length > self.MaxFrame:
+                raise ValueError('frame too large %d' % length)
+            if end - pos - hsize < length:
+                break
+            pos += hsize
+            frames.append(bytes(buf[pos:pos + length]))
+            pos += length
+        if pos:
+            del buf[:pos]
+        return frames
+
+    def pack(self, payload: bytes) -> bytes:
+        """ 给消息体加上长度头 """
+        return self.Header.pack(len(payload)) + payload
+
+    def pending(self) -> int:
+        """ 缓冲区中未完成的字节数 """
+        return len(self._buf)
+
+
+class LegacyDecoder(object):
+    """
+        旧的协议, 一次recv的数据当作一条完整消息
+    """
+    def feed(self, data) -> list:
+        return [bytes(data)]
+
+    def pack(self, payload: bytes) -> bytes:
+        return payload
+
+    def pending(self) -> int:
+        return 0
+
+
+def create_decoder(legacy=False):
+    return legacy and LegacyDecoder() or FrameDecoder()
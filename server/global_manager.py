@@ -1,12 +1,32 @@
-from multiprocessing import Lock
-from threading import Thread
+from threading import Lock
 from message import *
+from router import LocalRouter
+from log import get_logger
+
+logger = get_logger('global_manager')
+
+
+class _Shard(object):
+    """
+        连接表的一个分片, 每个分片有独立的锁
+        不同分片的用户登陆、查询和消息转发互不阻塞
+    """
+    __slots__ = ['lock', 'connected']
+
+    def __init__(self):
+        self.lock = Lock()
+        self.connected = {}
 
 
 class GlobalManger(object):
     __instance = None
     __inited = False
     _l = Lock()
+    # 分片数量, 需要在第一次创建GlobalManger前设置
+    ShardCount = 64
+    # 离线消息保存目录和每个用户最多保存的离线消息数
+    OfflineDir = './database/offline'
+    OfflineLimit = 1000
 
     def __new__(cls, *args, **kwargs):
         if not cls.__instance:
@@ -18,85 +38,147 @@ class GlobalManger(object):
         if not self.__inited:
             self.__inited = True
             self.__server = True
-            # self.__login_ids = set()
-            self.__connected = {}
-            self.__save_msg = {}
+            self.__shards = tuple(_Shard() for _ in range(self.ShardCount))
+            # 不在本进程的用户交给路由, 单进程模式下直接保存离线消息
+            self.__router = LocalRouter(self.OfflineDir, self.OfflineLimit)
         self._l.release()
 
+    def set_router(self, router):
+        """ 多进程模式下替换路由, 需要在接受连接之前调用 """
+        router.start(self.send_msg2ids)
+        self.__router = router
+
+    def _shard(self, id_) -> _Shard:
+        """ 按用户ID选择分片 """
+        return self.__shards[hash(id_) % len(self.__shards)]
+
     def add_connect(self, id_: str, trans):
-        self._l.acquire()
-        if self.__server:
-            # self.__login_ids.add(id_)
-            self.__connected[id_] = trans
-            if self.__save_msg.get(id_):
-                Thread(target=self._notify_connect, kwargs={'key': id_, 'conn': trans}).start()
-        self._l.release()
-        print('add_connect', id_, trans)
+        added = False
+        shard = self._shard(id_)
+        with shard.lock:
+            if self.__server:
+                shard.connected[id_] = trans
+                added = True
+        if added:
+            self.__router.user_online(id_)
+        logger.debug('add_connect %s %s', id_, trans)
 
     def del_connect(self, id_):
         conn = None
-        self._l.acquire()
-        if self.__server:
-            if self.__connected.get(id_):
-                # self.__login_ids.remove(id_)
-                conn = self.__connected.pop(id_)
-        self._l.release()
-        print('del_connect', conn)
+        shard = self._shard(id_)
+        with shard.lock:
+            if self.__server:
+                conn = shard.connected.pop(id_, None)
+        if conn:
+            self.__router.user_offline(id_)
+        logger.debug('del_connect %s', conn)
 
     def is_login(self, id_):
-        ret = False
-        self._l.acquire()
-        if self.__server:
-            if self.__connected.get(id_):
-                ret = True
-        self._l.release()
-        return ret
+        shard = self._shard(id_)
+        with shard.lock:
+            if not self.__server:
+                return False
+            if id_ in shard.connected:
+                return True
+        return self.__router.is_online(id_)
+
+    def connection_count(self) -> int:
+        """ 本进程当前在线的连接数 """
+        return sum(len(shard.connected) for shard in self.__shards)
+
+    def offline_depth(self) -> int:
+        """ 已加载的信箱中未确认的离线消息总数 """
+        return self.__router.offline.total_pending()
 
     def send_msg2id(self, toid, msg) -> bool:
         ret = False
-        self._l.acquire()
-        if self.__server:
-            trans = self.__connected.get(toid)
-            if trans:
-                ret = trans.recv_notify(msg)
-            else:  # 如果对方不在线则保存请求和同意消息, 等待对方上线再通知其处理
-                self._save_msg(toid, msg)
-                ret = True
-        self._l.release()
+        trans = None
+        shard = self._shard(toid)
+        with shard.lock:
+            if self.__server:
+                trans = shard.connected.get(toid)
+                if not trans:  # 对方不在本进程时交给路由, 不在线则保存请求和同意消息, 等待对方上线再通知其处理
+                    self.__router.route([toid], msg, self._can_save(msg))
+                    ret = True
+        # 对方的recv_notify只把消息放入其发送队列, 不需要持有锁
+        if trans:
+            ret = trans.recv_notify(msg)
         return ret
 
-    def _save_msg(self, toid, msg):
-        if type(msg) == RetOnlineNotifyMsg:
-            return
-        if not self.__save_msg.get(toid):
-            self.__save_msg[toid] = []
-        self.__save_msg[toid].append(msg)
-        if len(self.__save_msg[toid]) > 1000:
-            del self.__save_msg[toid][0]
+    def send_msg2ids(self, ids, msg, save_offline=True) -> int:
+        """
+            将同一条消息转发给多个用户, 每个分片只加锁一次
+            save_offline为False时不在线的用户直接跳过, 返回本进程中接收者的数量
+            也用于投递其他进程转发来的消息, 用户已经离开本进程时重新交给路由
+        """
+        save_offline = save_offline and self._can_save(msg)
+        shard_ids = {}
+        for id_ in ids:
+            shard_ids.setdefault(self._shard(id_), []).append(id_)
+        targets = []
+        for shard, id_list in shard_ids.items():
+            with shard.lock:
+                if not self.__server:
+                    return 0
+                missing = []
+                for id_ in id_list:
+                    trans = shard.connected.get(id_)
+                    if trans:
+                        targets.append(trans)
+                    else:
+                        missing.append(id_)
+                if missing:
+                    self.__router.route(missing, msg, save_offline)
+        for trans in targets:
+            trans.recv_notify(msg)
+        return len(targets)
 
     @staticmethod
-    def _add_msg2dict(msg, d, key, limit):
-        if not d.get(key):
-            d[key] = []
-        d[key].append(msg)
-        if len(d[key]) > limit:
-            del d[key][0]
+    def _can_save(msg) -> bool:
+        """ 上下线通知过期后没有意义, 不保存为离线消息 """
+        return type(msg) != RetOnlineNotifyMsg
 
-    @use_log
-    def _notify_connect(self, conn, key):
-        """ 如果再下线期间有没收到的消息，则上线后再通知 """
-        print(conn, key)
-        for msg in self.__save_msg[key]:
-            conn.recv_notify(msg)
-        self._l.acquire()
-        del self.__save_msg[key]
-        self._l.release()
+    def pending_offline(self, id_) -> int:
+        """
+            未确认的离线消息数量, 只在用户登陆后调用
+            多进程模式下是一次远程调用, 不能持有分片锁, 否则会阻塞同一分片的所有用户
+        """
+        return self.__router.offline.pending(id_)
+
+    def read_offline(self, id_, cursor: int, limit: int):
+        """
+            读取一页离线消息, 返回 (消息列表, 下一页游标, 之后剩余的数量)
+            用户在线时不会再保存新的离线消息, 读取时不需要持有锁
+        """
+        msgs = []
+        offline = self.__router.offline
+        end = offline.end(id_)
+        # 已经确认过的消息不再返回
+        cursor = max(cursor, end - offline.pending(id_))
+        for seq, data in offline.read(id_, cursor, limit):
+            cursor = seq + 1
+            try:
+                msgs.append(Message.create_msg(data.decode('utf-8')))
+            except ValueError as e:
+                logger.warning('%s offline message %d: %s', id_, seq, e)
+        return msgs, cursor, max(end - cursor, 0)
+
+    def ack_offline(self, id_, cursor: int):
+        """ 确认游标之前的离线消息已经送达, 从存储中删除, 和read_offline一样不需要持有锁 """
+        self.__router.offline.trim(id_, cursor)
 
     @use_log
     def close_all_connect(self):
-        self._l.acquire()
+        # 持有所有分片锁时清除标志, 之后add_connect不会再向已经清空的分片添加连接
+        for shard in self.__shards:
+            shard.lock.acquire()
         self.__server = False
-        self._l.release()
-        for key, trans in self.__connected.items():
-            trans.ready2exit()
-            del self.__connected[key]
+        for shard in self.__shards:
+            shard.lock.release()
+        for shard in self.__shards:
+            with shard.lock:
+                conns = list(shard.connected.values())
+                shard.connected.clear()
+            for trans in conns:
+                trans.ready2exit()
+        self.__router.close()
@@ -0,0 +1,605 @@
+# coding=utf-8
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from binary_proto import BinaryProto
+from framing import FrameDecoder
+from message import *
+from msg_crypto import MsgCrypto
+import codec
+
+"""
+    聊天协议的压力测试
+    模拟大量客户端通过真实的网络协议访问服务器, 统计吞吐量、延迟和服务器内存
+    python3 loadgen.py --spawn --clients 2000
+    python3 loadgen.py --port 7788 --server-pid 12345 --scenario chat find
+    python3 loadgen.py --spawn --server-arg=--mode=thread --output result.json
+    python3 loadgen.py --port 7788 7789 7790 --scenario chat presence
+
+    场景(总是先执行register注册所有模拟用户):
+        register    注册
+        login       登陆后注销, 反复执行
+        friend      两两添加好友并同意, 完成后互相删除, 反复执行
+        chat        好友之间互发聊天消息
+        find        按昵称/ID模糊查找
+        presence    一半用户保持在线, 其好友反复上线下线
+"""
+
+_binary = BinaryProto(Message.FieldTags)
+
+
+def _ok(reply) -> bool:
+    return reply is not None and reply.get('success', True)
+
+
+def _decode(frame: bytes) -> dict:
+    if BinaryProto.is_binary(frame):
+        return _binary.loads(frame)
+    return codec.loads(MsgCrypto.decrypto(frame.decode('utf-8')))
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _server_rss(pid):
+    """
+        从/proc读取服务器的当前和峰值常驻内存, 单位KB, 不支持时返回None
+        多进程模式下pid为主进程, 加上所有工作进程
+    """
+    if not pid:
+        return None
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            fields = dict(line.split(':', 1) for line in f)
+        rss, peak = int(fields['VmRSS'].split()[0]), int(fields['VmHWM'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        usage = _server_rss(child)
+        if usage:
+            rss += usage[0]
+            peak += usage[1]
+    return rss, peak
+
+
+class Stats(object):
+    """ 一个场景的统计数据, 时间单位秒 """
+    def __init__(self, name: str):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        """ 清空数据并重新开始计时 """
+        # 请求到收到回复的延迟
+        self.latency = []
+        # 推送的端到端延迟: 聊天为发出到对方收到, 好友为请求到收到同意
+        self.push_latency = []
+        self.sent = 0
+        self.recv = 0
+        self.pushes = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+        self.end = None
+        self.rss = None
+
+    def finish(self, server_pid):
+        self.end = time.perf_counter()
+        self.rss = _server_rss(server_pid)
+
+    def result(self) -> dict:
+        cost = (self.end or time.perf_counter()) - self.start
+        ms = lambda v: None if v is None else round(v * 1000, 3)
+        return {'scenario': self.name,
+                'seconds': round(cost, 3),
+                'requests': len(self.latency),
+                'requests_per_sec': round(len(self.latency) / cost, 1),
+                'msgs_per_sec': round((self.sent + self.recv) / cost, 1),
+                'p50_ms': ms(_percentile(self.latency, 0.5)),
+                'p99_ms': ms(_percentile(self.latency, 0.99)),
+                'pushes': self.pushes,
+                'push_p50_ms': ms(_percentile(self.push_latency, 0.5)),
+                'push_p99_ms': ms(_percentile(self.push_latency, 0.99)),
+                'errors': self.errors,
+                'rss_kb': self.rss and self.rss[0],
+                'peak_rss_kb': self.rss and self.rss[1]}
+
+
+class LoadClient(object):
+    """
+        模拟客户端
+        服务器按顺序处理同一连接上的请求, 回复依次对应发出的请求
+        其余消息(聊天/好友请求/上下线通知等)都是服务器的推送
+    """
+    ReplyCmds = (Message.Cmd.Receipt, Message.Cmd.RetUserInfo,
+                 Message.Cmd.RetFindResult, Message.Cmd.RetFriendInfo)
+
+    def __init__(self, runner, nick: str, pwd: str, port: int):
+        self.runner = runner
+        self.port = port
+        self.ID = '0'
+        self.nick = nick
+        self.pwd = pwd
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._decoder = FrameDecoder()
+        # 等待回复的请求, 按发送顺序排列
+        self._replies = collections.deque()
+        # (cmd, friend_id) -> 等待该推送的future
+        self._waiters = {}
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.runner.host, self.port)
+        self._decoder = FrameDecoder()
+        self._task = asyncio.ensure_future(self._read_loop())
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._task:
+            await self._task
+            self._task = None
+
+    async def request(self, msg: Message):
+        """ 发送请求并等待回复, 超时或连接断开返回None """
+        stats = self.runner.stats
+        if not self.connected:
+            stats.errors += 1
+            return None
+        fut = asyncio.get_event_loop().create_future()
+        self._replies.append(fut)
+        self._send(msg)
+        start = time.perf_counter()
+        try:
+            reply = await asyncio.wait_for(fut, self.runner.timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            stats.errors += 1
+            return None
+        stats.latency.append(time.perf_counter() - start)
+        if not _ok(reply):
+            stats.errors += 1
+        return reply
+
+    def expect(self, cmd: int, friend_id: str):
+        """ 在触发推送之前登记, 之后用wait等待 """
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters[(cmd, friend_id)] = fut
+        return fut
+
+    async def wait(self, fut):
+        try:
+            return await asyncio.wait_for(fut, self.runner.timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.runner.stats.errors += 1
+            for key, waiter in list(self._waiters.items()):
+                if waiter is fut:
+                    del self._waiters[key]
+            return None
+
+    async def register(self) -> bool:
+        msg = RegisterMsg(RegisterMsg.DefaultMsg)
+        msg.pwd = self.pwd
+        msg.nick_name = self.nick
+        reply = await self.request(msg)
+        if _ok(reply):
+            self.ID = reply['ID']
+            return True
+        return False
+
+    async def login(self, retry=3) -> bool:
+        """ 连接并登陆, 上一次连接还没有被服务器清理时登陆会被拒绝, 稍后重试 """
+        for _ in range(retry):
+            try:
+                await self.connect()
+            except OSError:
+                self.runner.stats.errors += 1
+                await asyncio.sleep(0.1)
+                continue
+            msg = LoginMsg(LoginMsg.DefaultMsg)
+            msg.ID = self.ID
+            msg.pwd = self.pwd
+            if _ok(await self.request(msg)):
+                return True
+            await self.close()
+            await asyncio.sleep(0.05)
+        return False
+
+    async def logout(self):
+        """ 服务器回复后主动断开连接 """
+        msg = LogoutMsg(LogoutMsg.DefaultMsg)
+        msg.ID = self.ID
+        await self.request(msg)
+        await self.close()
+
+    async def chat(self, friend_id: str, text: str):
+        msg = ChatMsg(ChatMsg.DefaultMsg)
+        msg.ID = self.ID
+        msg.friend_id = friend_id
+        msg.chat = text
+        return await self.request(msg)
+
+    async def add_friend(self, friend_id: str, add=True):
+        msg = AddDelFriendMsg(AddDelFriendMsg.DefaultMsg)
+        msg.ID = self.ID
+        msg.friend_id = friend_id
+        msg.add = add
+        return await self.request(msg)
+
+    async def accept(self, friend_id: str):
+        msg = AcceptDenyReqMsg(AcceptDenyReqMsg.DefaultMsg)
+        msg.ID = self.ID
+        msg.friend_id = friend_id
+        return await self.request(msg)
+
+    async def find(self, friend_id='', nick_name=''):
+        msg = FindFriendMsg(FindFriendMsg.DefaultMsg)
+        msg.ID = self.ID
+        msg.friend_id = friend_id
+        msg.nick_name = nick_name
+        msg.fuzzy = True
+        return await self.request(msg)
+
+    def _send(self, msg: Message):
+        payload = self.runner.binary and msg.msg_binary_bytes or msg.msg_crypto_bytes
+        self._writer.write(self._decoder.pack(payload))
+        self.runner.stats.sent += 1
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    break
+                for frame in self._decoder.feed(data):
+                    self._on_frame(_decode(frame))
+        except (OSError, ValueError):
+            self.runner.stats.errors += 1
+        finally:
+            # 连接断开或数据错误, 还在等待的请求全部失败
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            error = ConnectionError('connection closed')
+            for fut in list(self._replies) + list(self._waiters.values()):
+                if not fut.done():
+                    fut.set_exception(error)
+            self._replies.clear()
+            self._waiters.clear()
+
+    def _on_frame(self, msg: dict):
+        self.runner.stats.recv += 1
+        cmd = msg.get('cmd')
+        if cmd in self.ReplyCmds and self._replies:
+            fut = self._replies.popleft()
+            # 超时的请求已经被取消
+            if not fut.done():
+                fut.set_result(msg)
+            return
+        self.runner.on_push(msg)
+        fut = self._waiters.pop((cmd, msg.get('friend_id')), None)
+        if fut and not fut.done():
+            fut.set_result(msg)
+
+
+class LoadRunner(object):
+    """ 依次执行各个场景, 每个场景运行duration秒 """
+    Scenarios = ('register', 'login', 'friend', 'chat', 'find', 'presence')
+    Password = '12345678'
+
+    def __init__(self, args, server_pid=None):
+        self.host = args.host
+        self.binary = args.binary
+        self.timeout = args.timeout
+        self.server_pid = server_pid
+        self._args = args
+        self._rand = random.Random(args.seed)
+        self._deadline = 0
+        self._connect_sem = None
+        # 两两一组的好友, chat和presence场景使用
+        self._pairs = None
+        self.stats = Stats('setup')
+        self.results = []
+        # 指定多个端口时(集群的各个节点)客户端轮流连接, 好友之间的消息需要跨节点转发
+        self.clients = [LoadClient(self, self._nick(), self.Password, args.port[i % len(args.port)])
+                        for i in range(args.clients)]
+
+    async def run(self, scenarios):
+        self._connect_sem = asyncio.Semaphore(self._args.connect_concurrency)
+        await self._measure('register', self.scenario_register)
+        for name in scenarios:
+            if name != 'register':
+                await self._measure(name, getattr(self, 'scenario_' + name))
+        self.stats = Stats('teardown')
+        await self._logout_all(self.clients)
+
+    def on_push(self, msg: dict):
+        self.stats.pushes += 1
+        if msg.get('cmd') == Message.Cmd.Chat:
+            # 聊天内容以发送时间开头, 同一进程内perf_counter可以直接相减
+            sent = float(msg['chat'].split(' ', 1)[0])
+            self.stats.push_latency.append(time.perf_counter() - sent)
+
+    async def scenario_register(self, stats: Stats):
+        async def register(client):
+            async with self._connect_sem:
+                try:
+                    await client.connect()
+                except OSError:
+                    stats.errors += 1
+                    return
+                await client.register()
+                await client.close()
+
+        await asyncio.gather(*(register(c) for c in self.clients))
+        self.clients = [c for c in self.clients if c.ID != '0']
+
+    async def scenario_login(self, stats: Stats):
+        await self._logout_all(self.clients)
+        self._start(stats)
+
+        async def login_logout(client):
+            if not await client.login():
+                return False
+            await client.logout()
+            return True
+
+        await self._loop_all(login_logout, self.clients)
+
+    async def scenario_friend(self, stats: Stats):
+        await self._login_all(self.clients)
+        # 与_pairs错开, 避免和已经是好友的用户重复添加
+        clients = self.clients
+        pairs = [(clients[i], clients[(i + 1) % len(clients)]) for i in range(1, len(clients), 2)]
+        self._start(stats)
+
+        async def befriend(a, b):
+            if not await self._befriend(a, b):
+                return False
+            await a.add_friend(b.ID, add=False)
+            await b.add_friend(a.ID, add=False)
+            return True
+
+        await self._loop_all(befriend, *zip(*pairs))
+
+    async def scenario_chat(self, stats: Stats):
+        await self._ensure_pairs()
+        filler = 'x' * self._args.chat_size
+        self._start(stats)
+
+        async def chat(a, b):
+            return await a.chat(b.ID, '%r %s' % (time.perf_counter(), filler)) is not None
+
+        senders = [a for a, _ in self._pairs] + [b for _, b in self._pairs]
+        receivers = [b for _, b in self._pairs] + [a for a, _ in self._pairs]
+        await self._loop_all(chat, senders, receivers)
+
+    async def scenario_find(self, stats: Stats):
+        await self._login_all(self.clients)
+        self._start(stats)
+
+        async def find(client):
+            target = self._rand.choice(self.clients)
+            if self._rand.random() < 0.5:
+                size = self._rand.randint(3, len(target.nick))
+                start = self._rand.randint(0, len(target.nick) - size)
+                reply = await client.find(nick_name=target.nick[start:start + size])
+            else:
+                reply = await client.find(friend_id=target.ID[-4:])
+            return reply is not None
+
+        await self._loop_all(find, self.clients)
+
+    async def scenario_presence(self, stats: Stats):
+        await self._ensure_pairs()
+        churners = [b for _, b in self._pairs]
+        await self._logout_all(churners)
+        self._start(stats)
+
+        async def churn(client):
+            if not await client.login():
+                return False
+            await self._think()
+            await client.logout()
+            return True
+
+        await self._loop_all(churn, churners)
+
+    async def _measure(self, name, scenario):
+        stats = self.stats = Stats(name)
+        self._deadline = time.perf_counter() + self._args.duration
+        await scenario(stats)
+        stats.finish(self.server_pid)
+        self.results.append(stats.result())
+        print_result(self.results[-1], header=len(self.results) == 1)
+
+    def _start(self, stats: Stats):
+        """ 准备工作完成后重新开始计时, 之前的收发不计入统计 """
+        stats.reset()
+        self._deadline = stats.start + self._args.duration
+
+    async def _loop_all(self, func, *columns):
+        """ 每组参数一个协程, 重复执行func直到场景结束或func返回False """
+        async def loop(*args):
+            while time.perf_counter() < self._deadline:
+                if not await func(*args):
+                    return
+                await self._think()
+
+        await asyncio.gather(*(loop(*args) for args in zip(*columns)))
+
+    async def _think(self):
+        if self._args.think:
+            await asyncio.sleep(self._rand.uniform(0, 2 * self._args.think))
+        else:
+            # 让出事件循环, 避免单个客户端连续占用
+            await asyncio.sleep(0)
+
+    async def _befriend(self, a: LoadClient, b: LoadClient) -> bool:
+        """ a请求添加b为好友, b同意, 统计a发出请求到收到同意的时间 """
+        req = b.expect(Message.Cmd.AddDelFriend, a.ID)
+        accepted = a.expect(Message.Cmd.AcceptDenyReq, b.ID)
+        start = time.perf_counter()
+        if not _ok(await a.add_friend(b.ID)) or not await b.wait(req):
+            return False
+        if not _ok(await b.accept(a.ID)) or not await a.wait(accepted):
+            return False
+        self.stats.push_latency.append(time.perf_counter() - start)
+        return True
+
+    async def _ensure_pairs(self):
+        await self._login_all(self.clients)
+        if self._pairs is None:
+            clients = self.clients
+            self._pairs = [(clients[i], clients[i + 1]) for i in range(0, len(clients) - 1, 2)]
+            await asyncio.gather(*(self._befriend(a, b) for a, b in self._pairs))
+
+    async def _login_all(self, clients):
+        async def login(client):
+            async with self._connect_sem:
+                await client.login()
+
+        await asyncio.gather(*(login(c) for c in clients if not c.connected))
+
+    async def _logout_all(self, clients):
+        await asyncio.gather(*(c.logout() for c in clients if c.connected))
+
+    def _nick(self) -> str:
+        return ''.join(self._rand.choice(string.ascii_lowercase) for _ in range(8))
+
+
+class SpawnedServer(object):
+    """ 在临时目录中启动一个全新的服务器, 结束后发送SIGINT让其正常退出 """
+    def __init__(self, port: int, server_args):
+        self._dir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self._dir.name, 'database'))
+        main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+        self.proc = subprocess.Popen([sys.executable, main, '--port', str(port)] + list(server_args),
+                                     cwd=self._dir.name)
+        self._wait_ready(port)
+
+    @property
+    def pid(self) -> int:
+        return self.proc.pid
+
+    def _wait_ready(self, port: int, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError('server exited with %d' % self.proc.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError('server not ready after %d seconds' % timeout)
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self._dir.cleanup()
+
+
+def raise_fd_limit():
+    """ 每个模拟客户端占用一个文件描述符, 把软限制提高到硬限制 """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def print_result(result: dict, header=False):
+    """ 每个场景一行, 延迟单位毫秒, 内存单位KB """
+    columns = (('scenario', 'scenario', 10), ('requests', 'requests', 9), ('req/s', 'requests_per_sec', 9),
+               ('msgs/s', 'msgs_per_sec', 9), ('p50', 'p50_ms', 8), ('p99', 'p99_ms', 8),
+               ('pushes', 'pushes', 8), ('push p50', 'push_p50_ms', 9), ('push p99', 'push_p99_ms', 9),
+               ('errors', 'errors', 7), ('rss', 'rss_kb', 9), ('peak rss', 'peak_rss_kb', 9))
+    if header:
+        print(''.join('%*s' % (width, title) for title, _, width in columns))
+    print(''.join('%*s' % (width, '-' if result[key] is None else result[key])
+                  for _, key, width in columns), flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SimpleChatServer load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, nargs='+', default=[7788],
+                        help='服务器端口, 可以指定集群中多个节点的端口')
+    parser.add_argument('--scenario', nargs='+', choices=LoadRunner.Scenarios, default=LoadRunner.Scenarios,
+                        help='要执行的场景, 默认全部')
+    parser.add_argument('--clients', type=int, default=1000, help='模拟客户端数量, 至少4个')
+    parser.add_argument('--duration', type=float, default=10, help='每个场景的运行秒数')
+    parser.add_argument('--think', type=float, default=0,
+                        help='客户端两次操作之间的平均间隔秒数, 0表示收到回复后立即发送下一条')
+    parser.add_argument('--chat-size', type=int, default=32, help='聊天消息填充的字节数')
+    parser.add_argument('--timeout', type=float, default=10, help='等待回复的超时秒数, 超时计为错误')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='同时进行连接和登陆的客户端数')
+    parser.add_argument('--binary', action='store_true', help='使用二进制消息编码')
+    parser.add_argument('--codec', choices=['auto'] + [c.name for c in codec.Codecs], default='auto')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server-pid', type=int, default=None, help='服务器进程号, 用于读取内存占用')
+    parser.add_argument('--spawn', action='store_true', help='在临时目录中启动新的服务器, 结束后关闭')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='--spawn时传给服务器的参数, 如 --server-arg=--mode=thread, 可以多次指定')
+    parser.add_argument('--output', default=None, help='将结果以JSON写入文件, 便于比较不同版本')
+    args = parser.parse_args()
+    if args.clients < 4:
+        parser.error('--clients must be at least 4')
+    return args
+
+
+def main():
+    args = parse_args()
+    codec.use(args.codec)
+    raise_fd_limit()
+    server = args.spawn and SpawnedServer(args.port[0], args.server_arg) or None
+    runner = LoadRunner(args, server and server.pid or args.server_pid)
+    print('clients=%d duration=%ss binary=%s codec=%s' % (len(runner.clients), args.duration,
+                                                          args.binary, codec.current.name))
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.run(args.scenario))
+        loop.close()
+    finally:
+        if server:
+            server.stop()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': runner.results}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+"""
+    服务器日志
+    各模块通过get_logger获取自己的日志, 名字为 chat.<模块名>, 可以分别设置级别
+    setup之后日志记录只放入队列, 由后台线程写到输出, 不阻塞处理消息的线程
+    setup之前只输出WARNING以上的日志
+"""
+
+__all__ = ['get_logger', 'setup', 'shutdown', 'parse_levels']
+
+Root = 'chat'
+Format = '%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s'
+
+_listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """ 返回模块的日志, name使用模块名 """
+    return logging.getLogger(Root + '.' + name)
+
+
+def parse_levels(specs) -> dict:
+    """ 解析 "transfer=DEBUG" 形式的模块日志级别 """
+    levels = {}
+    for spec in specs or ():
+        name, sep, level = spec.partition('=')
+        if not sep or not name:
+            raise ValueError('log level format error: %s' % spec)
+        levels[name] = level.upper()
+    return levels
+
+
+def setup(level='INFO', module_levels=None, stream=None):
+    """ 启动后台写日志线程, module_levels 为 {模块名: 级别} """
+    global _listener
+    shutdown()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(Format))
+    records = queue.Queue()
+    _listener = logging.handlers.QueueListener(records, handler)
+
+    root = logging.getLogger(Root)
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level.upper())
+    root.propagate = False
+    for name, module_level in (module_levels or {}).items():
+        get_logger(name).setLevel(module_level)
+    _listener.start()
+
+
+def shutdown():
+    """ 写完队列中剩余的日志后停止后台线程 """
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
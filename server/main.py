@@ -1,18 +1,44 @@
 # coding=utf-8
+import argparse
+import os
 import socket
 import signal
+import threading
 from transfer import Transfer
+from async_transfer import AsyncServer
+from send_queue import SendQueue
 from database import *
 from global_manager import *
+from presence import Presence
+from router import Broker, BrokerRouter, ClusterRouter
+from log import get_logger
+import codec
+import log
+import metrics
+import time
 
 
 """
     1.解决返回朋友列表时的class字段
 """
 
+logger = get_logger('main')
+
+# 多进程模式下工作进程与主进程通信的Unix socket
+BrokerPath = './database/broker.sock'
+
 
 def ready2exit(sig, frame):
-    global server, db, gb
+    global server, aserver, db, gb, exiting
+    # 退出过程中再次收到信号(如Ctrl-C同时发给了主进程和工作进程)时直接返回, 避免重复加锁造成死锁
+    if exiting:
+        return
+    exiting = True
+    if aserver:
+        # 协程模式下监听socket由事件循环关闭
+        aserver.stop()
+        aserver = None
+        server = None
     if server:
         server.shutdown(socket.SHUT_RDWR)
         server.close()
@@ -21,9 +47,10 @@ def ready2exit(sig, frame):
         db.close()
         db = None
     if gb:
+        Presence().close()
         gb.close_all_connect()
         gb = None
-    print('signal %d %s' % (sig, frame))
+    logger.info('signal %d %s', sig, frame)
 
 
 def register_signal():
@@ -33,31 +60,201 @@ def register_signal():
         signal.signal(sig, ready2exit)
 
 
-def create_server_socket(port: int):
+def register_gauges(db, gb):
+    """ 注册服务器状态指标, 在输出指标时读取 """
+    def since_last_sync():
+        last = db.last_sync_time()
+        return last and time.time() - last
+
+    metrics.Gauge('chat_connections', '在线连接数', func=gb.connection_count)
+    metrics.Gauge('chat_offline_messages', '已加载信箱中未确认的离线消息数', func=gb.offline_depth)
+    metrics.Gauge('chat_db_seconds_since_sync', '距离上次数据库写入磁盘的秒数', func=since_last_sync)
+
+
+def create_server_socket(port: int, reuse_port=False):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        # 每个工作进程各自监听同一端口, 由内核分配新连接
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind(('', port))
     sock.listen()
     return sock
 
 
-if __name__ == '__main__':
-    server = None
-    db = None
-    gb = None
+def parse_args():
+    parser = argparse.ArgumentParser(description='SimpleChatServer')
+    parser.add_argument('--port', type=int, default=7788, help='监听端口')
+    parser.add_argument('--mode', choices=['async', 'thread'], default='async',
+                        help='async: 单事件循环处理所有连接; thread: 每个客户端一个线程')
+    parser.add_argument('--legacy-frame', action='store_true',
+                        help='使用旧协议, 不加长度头, 一次recv即一条消息')
+    parser.add_argument('--db', default=None,
+                        help='数据库地址, 如 sqlite:///./database/chat.db, 不指定时使用文件数据库')
+    parser.add_argument('--codec', choices=['auto'] + [c.name for c in codec.Codecs], default='auto',
+                        help='JSON编解码实现, auto优先使用已安装的orjson')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help='日志级别')
+    parser.add_argument('--log-module', action='append', metavar='MODULE=LEVEL',
+                        help='单独设置模块的日志级别, 如 --log-module transfer=DEBUG, 可以多次指定')
+    parser.add_argument('--admin-port', type=int, default=0,
+                        help='在127.0.0.1的该端口上提供 /metrics 运行指标, 0表示不开启, '
+                             '多进程模式下第i个工作进程使用该端口+i')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='工作进程数, 大于1时每个进程独立监听同一端口, 需要使用SQLite数据库')
+    parser.add_argument('--cluster', default=None, metavar='HOST:PORT,...',
+                        help='集群模式, 所有节点的节点间通信地址, 各节点使用相同的列表, 需要共享同一个SQLite数据库')
+    parser.add_argument('--node-id', type=int, default=0,
+                        help='集群模式下本节点在 --cluster 列表中的序号')
+    parser.add_argument('--cluster-secret', default=os.environ.get('CHAT_CLUSTER_SECRET'),
+                        help='集群节点之间握手使用的共享密钥, 默认读取环境变量 CHAT_CLUSTER_SECRET')
+    parser.add_argument('--send-queue', type=int, default=1024,
+                        help='每个连接发送队列的最大消息数')
+    parser.add_argument('--slow-policy', choices=SendQueue.Policies, default=SendQueue.Drop,
+                        help='发送队列满时的处理策略: 丢弃消息/断开连接/阻塞发送方')
+    args = parser.parse_args()
+    if args.workers > 1:
+        if not args.db:
+            parser.error('--workers requires --db, the file database can not be shared between processes')
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+            parser.error('--workers is not supported on this platform')
+    if args.cluster:
+        if not args.db:
+            parser.error('--cluster requires --db, the file database can not be shared between nodes')
+        if args.workers > 1:
+            parser.error('--cluster can not be used with --workers')
+        try:
+            args.cluster = ClusterRouter.parse_nodes(args.cluster)
+        except ValueError:
+            parser.error('invalid --cluster %s' % args.cluster)
+        if not 0 <= args.node_id < len(args.cluster):
+            parser.error('--node-id out of range')
+        if not args.cluster_secret:
+            parser.error('--cluster requires --cluster-secret or CHAT_CLUSTER_SECRET')
+    return args
+
+
+def serve_thread(sock: socket.socket, **trans_kwargs):
+    """ 线程模式, 每个客户端创建一个线程 """
+    cnt = 0
+    while True:
+        # 等待客户端连接
+        client, _ = sock.accept()
+        # 创建子线程处理客户端
+        Transfer(client, '第' + str(cnt) + '个线程', **trans_kwargs).start()
+        cnt += 1
+
+
+def serve(args, router=None, admin_port=0, reuse_port=False):
+    """ 启动服务器直到收到退出信号, router不为None时通过它和其他进程或节点交换消息 """
+    global server, aserver, db, gb
     try:
-        server = create_server_socket(7788)
+        server = create_server_socket(args.port, reuse_port=reuse_port)
         register_signal()
-        db = Database.create_db()
+        # 编解码实现需要在加载数据库之前选择
+        logger.info('codec %s', codec.use(args.codec))
+        db = Database.create_db(args.db)
         gb = GlobalManger()
+        if router:
+            if not db.Shared:
+                raise Exception('%s can not be shared between processes' % type(db).__name__)
+            gb.set_router(router)
+        if admin_port:
+            register_gauges(db, gb)
+            metrics.start_admin(admin_port)
 
-        cnt = 0
-        while True:
-            # 等待客户端连接
-            client, _ = server.accept()
-            # 创建子线程处理客户端
-            Transfer(client, '第' + str(cnt) + '个线程').start()
-            cnt += 1
+        trans_kwargs = {'legacy': args.legacy_frame,
+                        'queue_size': args.send_queue,
+                        'queue_policy': args.slow_policy}
+        if args.mode == 'async':
+            aserver = AsyncServer(server, **trans_kwargs)
+            aserver.serve_forever()
+        else:
+            serve_thread(server, **trans_kwargs)
 
     except Exception as e:
-        print(e, type(e))
+        # 收到退出信号后监听socket已经关闭, accept抛出的异常不需要记录
+        if server:
+            logger.exception('server error')
         ready2exit(0, None)
+
+
+def serve_workers(args):
+    """
+        多进程模式, 主进程运行Broker, 转发跨进程的消息并统一保存离线消息
+        工作进程在创建任何线程之前fork, 每个工作进程独立监听端口并处理自己的连接
+    """
+    os.makedirs(os.path.dirname(BrokerPath), exist_ok=True)
+    broker = Broker(BrokerPath, GlobalManger.OfflineDir, GlobalManger.OfflineLimit)
+    workers = {}
+    for i in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            broker.detach()
+            run_worker(args, i)
+        workers[pid] = i
+
+    log.setup(args.log_level, log.parse_levels(args.log_module))
+
+    stopping = False
+
+    def stop_workers(sig, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        logger.info('signal %d, stop workers', sig)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, stop_workers)
+    broker.start()
+    logger.info('broker %s, %d workers', BrokerPath, args.workers)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = workers.pop(pid, None)
+        if status:
+            logger.warning('worker %s exit with status %d', worker, status)
+    broker.close()
+
+
+def run_worker(args, worker: int):
+    """ 工作进程入口, 不会返回 """
+    threading.current_thread().name = 'worker%d' % worker
+    log.setup(args.log_level, log.parse_levels(args.log_module))
+    code = 1
+    try:
+        # 主进程退出后无法再转发消息, 工作进程也随之退出
+        router = BrokerRouter(BrokerPath, worker, on_lost=lambda: os.kill(os.getpid(), signal.SIGTERM))
+        serve(args, router, args.admin_port and args.admin_port + worker, reuse_port=True)
+        code = 0
+    finally:
+        log.shutdown()
+        os._exit(code)
+
+
+if __name__ == '__main__':
+    exiting = False
+    server = None
+    aserver = None
+    db = None
+    gb = None
+    args = parse_args()
+    if args.workers > 1:
+        serve_workers(args)
+    elif args.cluster:
+        log.setup(args.log_level, log.parse_levels(args.log_module))
+        # 各节点的离线信箱分开存放, 同一目录下运行多个节点时不会冲突
+        offline_dir = os.path.join(GlobalManger.OfflineDir, 'node%d' % args.node_id)
+        router = ClusterRouter(args.node_id, args.cluster, args.cluster_secret,
+                               offline_dir, GlobalManger.OfflineLimit)
+        serve(args, router, admin_port=args.admin_port)
+    else:
+        log.setup(args.log_level, log.parse_levels(args.log_module))
+        serve(args, admin_port=args.admin_port)
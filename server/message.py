@@ -1,18 +1,56 @@
 from utils import *
 from msg_crypto import *
-from user import Storable
-import json
+from binary_proto import BinaryProto
+from log import get_logger
+import codec
 
+logger = get_logger('message')
 
-class Message(object):
+
+class _Field(object):
+    """
+        消息字段描述符, 读写直接访问消息字典
+        修改字段时清除缓存的序列化结果
+    """
+    __slots__ = ['name']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return obj._attrs_dict[self.name]
+
+    def __set__(self, obj, value):
+        obj._attrs_dict[self.name] = value
+        obj._json_cache = None
+        obj._crypto_cache = None
+        obj._binary_cache = None
+        obj._frame_cache = None
+
+
+class _MessageMeta(type):
+    """
+        根据_keys为每个消息类生成字段描述符和_attrs
+        消息类都使用__slots__, 设置不存在的字段时抛出AttributeError
+    """
+    def __new__(mcs, name, bases, namespace):
+        keys = namespace.get('_keys', [])
+        attrs = ('ID', 'cmd', 'msgid') + tuple(keys)
+        for key in attrs:
+            namespace.setdefault(key, _Field(key))
+        namespace['_attrs'] = attrs
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class Message(object, metaclass=_MessageMeta):
     """
         所有消息基类
     """
-    # 这里写这些属性是为了便于PyCharm好提示
-    __slots__ = ['ID', 'cmd', 'msgid', 'pwd', 'success', 'user',
-                 'nick_name', 'online', 'friend_id', 'reason', 'result', 'fuzzy',
-                 'group', 'add', 'accept', 'allow_find', 'old_pwd',
-                 'new_pwd', 'chat', 'exe_cmd']
+    # 字段描述符由_MessageMeta根据_keys生成, 实例只保存消息字典和序列化缓存
+    __slots__ = ['_attrs_dict', '_json_cache', '_crypto_cache', '_binary_cache', '_frame_cache']
 
     __TypeMap = {'cmd': int,            # 消息命令字
                  'msgid': int,          # 消息编号，暂时忽略
@@ -33,8 +71,20 @@ class Message(object):
                  'allow_find': bool,    # 允许或拒绝查找
                  'add': bool,           # 添加/删除
                  'result': dict,        # 返回查询结果字典
+                 'cursor': int,         # 离线消息游标
+                 'limit': int,          # 每页离线消息数量
+                 'remain': int,         # 剩余离线消息数量
+                 'user': dict,          # 用户信息
+                 'moveto': str,         # 删除分组时好友移动到的分组
+                 'sex': str,            # 性别
+                 'birthday': str,       # 生日
+                 'desc': str,           # 个人描述
+                 'ext_info': dict,      # 扩展信息
                  }
+    # 二进制编码使用的字段编号, 按字段类型表的顺序生成, 新字段只能追加在最后
+    FieldTags = {k: i + 1 for i, k in enumerate(__TypeMap)}
 
+    _keys = []
     DefaultMsg = []
     SpecialChar = {'\\': '[&124:]'}
 
@@ -51,63 +101,32 @@ class Message(object):
         FindFriend = 9
         SetInfo = 10
         ModifyPassword = 11
+        SyncOffline = 12
+        RetOffline = 94
         RetFindResult = 95
         RetFriendInfo = 96
         RetOnlineNotify = 97
         RetUserInfo = 98
         Receipt = 99
 
-    # 所有的类属性，实例属性，方法需在这里写一下, 不然拦截set/get方法后会提示找不到属性
-    __InnerAttrs = ('_attrs', '_attrs_dict', '_keys',
-                    'DefaultMsg', 'SpecialChar', 'Cmd',
-                    '_check_dict', '_check_value',
-                    'msg_crypto_bytes', 'msg', 'msg_json_bytes')
-
-    def __new__(cls, *args, **kwargs):
-        """
-            __attrs 保存该消息格式中的字段
-            _attrs 为子类的独有属性，通过子类的类属性设置，然后将其追加到__attrs实例属性中
-        """
-        obj = super().__new__(cls)
-        obj._attrs = ['ID', 'cmd', 'msgid']
-        obj._attrs.extend(obj._keys)
-        return obj
-
     def __init__(self, attr_dict: dict):
         # print(attr_dict)
         """ 检测消息的长度和基本格式,然后将消息中的字段赋值给每个属性 """
+        if attr_dict is self.DefaultMsg:
+            # DefaultMsg是类属性, 复制一份避免同类消息共用一个字典
+            attr_dict = dict(attr_dict)
         self._attrs_dict = attr_dict
+        # 序列化结果缓存, 同一条消息转发给多个用户时只编码一次
+        self._json_cache = None
+        self._crypto_cache = None
+        self._binary_cache = None
+        self._frame_cache = None
         self._check_dict(attr_dict)
 
-    def __setattr__(self, key, value):
-        """ 拦截属性设置，直接修改字典中的值  """
-        # print('set %s' % key)
-        # 属性设置的时候通过父类方法设置，避免递归
-        if key in Message.__InnerAttrs:
-            # print(key, value)
-            super().__setattr__(key, value)
-        elif key in self._attrs:
-            # 这里设置实际是先get到_attrs_dict ,然后对 _attrs_dict 的key设置值
-            # 不是对_attrs_dict本身赋值，所以没有递归
-            self._attrs_dict[key] = value
-        else:
-            raise AttributeError('%s no attribute %s' % (self.__class__, key))
-
-    def __getattribute__(self, key):
-        """ 返回属性值 """
-        # print('get %s' % key)
-        if key in Message.__InnerAttrs:
-            return super().__getattribute__(key)
-        elif key in super().__getattribute__('_attrs'):
-            return super().__getattribute__('_attrs_dict')[key]
-        else:
-            raise AttributeError('%s no attribute %s' % (super().__getattribute__('__class__'), key))
-
-
     def _check_dict(self, attr_dict: dict):
         """ 检查消息字典与本类消息是否相符合 """
         if len(attr_dict) != len(self._attrs):
-            print(attr_dict, self._attrs)
+            logger.debug('%s %s', attr_dict, self._attrs)
             raise Exception('msg type not match %d %d' % (len(attr_dict), len(self._attrs)))
         for attr in self._attrs:
             # 如果key不存在, 直接抛给上层处理
@@ -124,46 +143,73 @@ class Message(object):
         """ 消息类工厂方法 """
         try:
             msg = MsgCrypto.decrypto(msg)
-            msg_dict = json.loads(msg)
-        except json.JSONDecodeError as e:
-            print(msg)
-            print(e)
+            msg_dict = codec.loads(msg)
+        except ValueError as e:
+            logger.debug('%s: %r', e, msg)
             raise ValueError('message format error')
+        return Message._create(msg_dict)
+
+    @staticmethod
+    def create_msg_binary(data: bytes):
+        """ 二进制消息的工厂方法 """
+        return Message._create(_binary.loads(data))
 
+    @staticmethod
+    def _create(msg_dict: dict):
         if len(msg_dict) < 3:  # 最短消息 ID cmd msgid
             raise ValueError('message format error')
 
-        obj_map = {Message.Cmd.Login: LoginMsg,
-                   Message.Cmd.Register: RegisterMsg,
-                   Message.Cmd.Logout: LogoutMsg,
-                   Message.Cmd.Chat: ChatMsg,
-                   Message.Cmd.AddDelFriend: AddDelFriendMsg,
-                   Message.Cmd.AddDelGroup: AddDelGroupMsg,
-                   Message.Cmd.AcceptDenyReq: AcceptDenyReqMsg,
-                   Message.Cmd.QueryFriendInfo: QueryFriendInfoMsg,
-                   Message.Cmd.FindFriend: FindFriendMsg,
-                   Message.Cmd.SetInfo: SetInfoMsg,
-                   Message.Cmd.ModifyPassword: ModifyPasswordMsg,
-                   Message.Cmd.ReqUserInfo: ReqUserInfoMsg
-                   }
-
-        if msg_dict['cmd'] not in obj_map:
+        cls = _MsgTypes.get(msg_dict['cmd'])
+        if cls is None:
             raise ValueError('message command error')
-        return obj_map[msg_dict['cmd']](msg_dict)
+        return cls(msg_dict)
 
     @property
     def msg(self):
         return str(self._attrs_dict)
 
+    @property
+    def msg_dict(self):
+        return self._attrs_dict
+
     @property
     def msg_crypto_bytes(self):
-        s = json.dumps(self._attrs_dict, default=Storable.encode)
-        # print(MsgCrypto.encrypto(s).encode('utf-8').decode('utf-8'))
-        return MsgCrypto.encrypto(s).encode('utf-8')
+        """ 加密后的消息, 结果会被缓存, 原地修改嵌套的字段后需要重新赋值才会更新 """
+        if self._crypto_cache is None:
+            # print(MsgCrypto.encrypto(s).encode('utf-8').decode('utf-8'))
+            self._crypto_cache = MsgCrypto.encrypto(self._json()).encode('utf-8')
+        return self._crypto_cache
+
+    @property
+    def msg_json(self) -> str:
+        return self._json()
 
     @property
     def msg_json_bytes(self):
-        return json.dumps(self._attrs_dict, default=Storable.encode).encode('utf-8')
+        return self._json().encode('utf-8')
+
+    @property
+    def msg_binary_bytes(self):
+        """ 二进制编码的消息, 和msg_crypto_bytes一样会被缓存 """
+        if self._binary_cache is None:
+            self._binary_cache = _binary.dumps(self._attrs_dict)
+        return self._binary_cache
+
+    def frame_bytes(self, decoder, binary=False) -> bytes:
+        """ 按decoder的格式封帧后的消息, 每种帧格式和编码的组合只封一次 """
+        key = (type(decoder), binary)
+        if self._frame_cache is None:
+            self._frame_cache = {}
+        frame = self._frame_cache.get(key)
+        if frame is None:
+            payload = binary and self.msg_binary_bytes or self.msg_crypto_bytes
+            frame = self._frame_cache[key] = decoder.pack(payload)
+        return frame
+
+    def _json(self) -> str:
+        if self._json_cache is None:
+            self._json_cache = codec.dumps(self._attrs_dict)
+        return self._json_cache
 
 
 ''' -------------------------------请求消息----------------------------------- '''
@@ -294,6 +340,17 @@ class ModifyPasswordMsg(Message):
                   }
 
 
+class SyncOfflineMsg(Message):
+    """ 离线消息同步, 确认cursor之前的消息已收到, 并请求从cursor开始的limit条消息 """
+    _keys = ['cursor', 'limit']
+    DefaultMsg = {"ID": "0",
+                  "cmd": Message.Cmd.SyncOffline,
+                  "msgid": 0,
+                  "cursor": 0,
+                  "limit": 100
+                  }
+
+
 ''' -------------------------------响应消息----------------------------------- '''
 
 
@@ -330,6 +387,17 @@ class RetFriendInfoMsg(Message):
                   'result': None}
 
 
+class RetOfflineMsg(Message):
+    """ 一页离线消息, cursor为下一页的起始游标, remain为之后剩余的消息数量 """
+    _keys = ['cursor', 'remain', 'result']
+    DefaultMsg = {'ID': '0',
+                  'cmd': Message.Cmd.RetOffline,
+                  'msgid': 0,
+                  'cursor': 0,
+                  'remain': 0,
+                  'result': None}
+
+
 class RetFindResultMsg(Message):
     _keys = ['result']
     DefaultMsg = {'ID': '0',
@@ -350,4 +418,20 @@ class ReceiptMsg(Message):
                   'reason': 'message format error'}
 
 
-
+# 请求消息命令字到消息类的映射, 供create_msg使用
+_MsgTypes = {Message.Cmd.Login: LoginMsg,
+             Message.Cmd.Register: RegisterMsg,
+             Message.Cmd.Logout: LogoutMsg,
+             Message.Cmd.Chat: ChatMsg,
+             Message.Cmd.AddDelFriend: AddDelFriendMsg,
+             Message.Cmd.AddDelGroup: AddDelGroupMsg,
+             Message.Cmd.AcceptDenyReq: AcceptDenyReqMsg,
+             Message.Cmd.QueryFriendInfo: QueryFriendInfoMsg,
+             Message.Cmd.FindFriend: FindFriendMsg,
+             Message.Cmd.SetInfo: SetInfoMsg,
+             Message.Cmd.ModifyPassword: ModifyPasswordMsg,
+             Message.Cmd.ReqUserInfo: ReqUserInfoMsg,
+             Message.Cmd.SyncOffline: SyncOfflineMsg
+             }
+
+_binary = BinaryProto(Message.FieldTags)
@@ -0,0 +1,163 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from log import get_logger
+
+"""
+    服务器运行指标
+    Counter/Histogram/Gauge创建时自动注册, render按Prometheus文本格式输出所有指标
+    start_admin在本机端口上提供 GET /metrics
+"""
+
+__all__ = ['Counter', 'Histogram', 'Gauge', 'render', 'start_admin']
+
+logger = get_logger('metrics')
+
+_metrics = []
+_metrics_l = Lock()
+
+
+class _Metric(object):
+    Type = None
+
+    def __init__(self, name: str, help_: str, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._l = Lock()
+        with _metrics_l:
+            _metrics.append(self)
+
+    def render(self) -> list:
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.Type)]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list:
+        return []
+
+    def _label_str(self, values, extra=None) -> str:
+        pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return pairs and '{%s}' % ','.join(pairs) or ''
+
+
+class Counter(_Metric):
+    """ 只增不减的计数, 按标签值分别计数 """
+    Type = 'counter'
+
+    def __init__(self, name, help_, labels=()):
+        super().__init__(name, help_, labels)
+        self._values = {}
+
+    def inc(self, *label_values, n=1):
+        with self._l:
+            self._values[label_values] = self._values.get(label_values, 0) + n
+
+    def _samples(self):
+        with self._l:
+            values = list(self._values.items())
+        return ['%s%s %s' % (self.name, self._label_str(k), v) for k, v in values]
+
+
+class Histogram(_Metric):
+    """ 分布统计, 记录落入每个区间的次数以及总和 """
+    Type = 'histogram'
+    # 默认区间, 单位秒, 适合统计消息处理耗时
+    Buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, name, help_, labels=(), buckets=None):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets or self.Buckets)
+        # 标签值 -> [各区间计数(最后一个为+Inf), 总和]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._l:
+            data = self._values.get(label_values)
+            if data is None:
+                data = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][i] += 1
+            data[1] += value
+
+    def _samples(self):
+        with self._l:
+            values = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        lines = []
+        for k, counts, total in values:
+            acc = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                acc += count
+                le = bound == float('inf') and '+Inf' or repr(bound)
+                lines.append('%s_bucket%s %d' % (self.name, self._label_str(k, 'le="%s"' % le), acc))
+            lines.append('%s_sum%s %s' % (self.name, self._label_str(k), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, self._label_str(k), acc))
+        return lines
+
+
+class Gauge(_Metric):
+    """ 当前值, 可以直接设置, 也可以在输出时调用func获取, func返回None时不输出 """
+    Type = 'gauge'
+
+    def __init__(self, name, help_, func=None):
+        super().__init__(name, help_)
+        self._func = func
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def _samples(self):
+        value = self._func() if self._func else self._value
+        if value is None:
+            return []
+        return ['%s %s' % (self.name, repr(value))]
+
+
+def render() -> str:
+    """ 按Prometheus文本格式输出所有指标 """
+    with _metrics_l:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            logger.exception('render metric %s error', metric.name)
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _AdminHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logger.debug('admin %s - %s', self.address_string(), fmt % args)
+
+
+class _AdminServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_admin(port: int, host='127.0.0.1'):
+    """ 在后台线程中启动指标HTTP服务, 只监听本机地址 """
+    server = _AdminServer((host, port), _AdminHandler)
+    Thread(target=server.serve_forever, name='admin', daemon=True).start()
+    logger.info('admin listening on %s:%d', host, port)
+    return server
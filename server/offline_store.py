@@ -0,0 +1,188 @@
+import os
+import struct
+
+__all__ = ['OfflineStore']
+
+
+class _Mailbox(object):
+    """
+        一个用户的离线消息信箱, 由多个段文件组成的只追加日志
+        目录结构:
+            head                第一条未投递消息的序号
+            <base>.log          段数据文件, 每条记录为 4字节长度 + 消息
+            <base>.idx          段偏移索引, 每条记录的起始偏移, 8字节
+        段文件名base为该段第一条消息的序号, 每段固定保存SegmentSize条消息
+        通过序号即可定位段和段内偏移, 入队和淘汰都是O(1)
+    """
+    __slots__ = ['path', 'head', 'tail']
+
+    Length = struct.Struct('!I')
+    Offset = struct.Struct('!Q')
+    SegmentSize = 256
+
+    def __init__(self, path: str):
+        self.path = path
+        self.head = 0
+        self.tail = 0
+        if os.path.isdir(path):
+            self._load()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def append(self, data: bytes):
+        """ 在末尾追加一条消息 """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        base = self._segment(self.tail)
+        with open(self._file(base, 'log'), 'ab') as log:
+            offset = log.tell()
+            log.write(self.Length.pack(len(data)))
+            log.write(data)
+        # 先写数据再写索引, 崩溃时最多丢失最后一条没有索引的消息
+        with open(self._file(base, 'idx'), 'ab') as idx:
+            idx.write(self.Offset.pack(offset))
+        self.tail += 1
+
+    def trim(self, upto: int):
+        """ 丢弃序号小于upto的消息, 删除已经全部丢弃的段 """
+        upto = min(max(upto, self.head), self.tail)
+        if upto == self.head:
+            return
+        old_base = self._segment(self.head)
+        self.head = upto
+        # head所在的段还会继续追加, 不能删除
+        for base in range(old_base, self._segment(self.head), self.SegmentSize):
+            self._remove_segment(base)
+        self._save_head()
+
+    def read(self, start: int, count: int):
+        """ 从序号start开始按顺序读取最多count条消息, 返回 (序号, 消息) 的生成器 """
+        seq = max(start, self.head)
+        end = min(seq + count, self.tail)
+        while seq < end:
+            base = self._segment(seq)
+            with open(self._file(base, 'idx'), 'rb') as idx:
+                idx.seek((seq - base) * self.Offset.size)
+                offset, = self.Offset.unpack(idx.read(self.Offset.size))
+            with open(self._file(base, 'log'), 'rb') as log:
+                log.seek(offset)
+                # 同一段内的消息连续存放, 顺序读取即可
+                while seq < end and seq < base + self.SegmentSize:
+                    length, = self.Length.unpack(log.read(self.Length.size))
+                    yield seq, log.read(length)
+                    seq += 1
+
+    def _load(self):
+        """ 从磁盘恢复head和tail """
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.idx'))
+        try:
+            with open(os.path.join(self.path, 'head')) as f:
+                self.head = int(f.read())
+        except (IOError, ValueError):
+            self.head = 0
+        if not bases:
+            self.tail = self.head
+            return
+        self.head = max(self.head, bases[0])
+        last = bases[-1]
+        self.tail = max(last + self._check_segment(last), self.head)
+
+    def _check_segment(self, base) -> int:
+        """ 检查最后一段的完整性, 截断没有写完的记录, 返回段内消息数量 """
+        idx_path = self._file(base, 'idx')
+        log_path = self._file(base, 'log')
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        with open(idx_path, 'rb') as idx:
+            data = idx.read()
+        count = len(data) // self.Offset.size
+        while count:
+            offset, = self.Offset.unpack_from(data, (count - 1) * self.Offset.size)
+            if offset + self.Length.size <= log_size:
+                with open(log_path, 'rb') as log:
+                    log.seek(offset)
+                    length, = self.Length.unpack(log.read(self.Length.size))
+                if offset + self.Length.size + length <= log_size:
+                    break
+            count -= 1
+        if count * self.Offset.size != len(data):
+            with open(idx_path, 'r+b') as idx:
+                idx.truncate(count * self.Offset.size)
+        return count
+
+    def _save_head(self):
+        path = os.path.join(self.path, 'head')
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(self.head))
+        os.replace(path + '.tmp', path)
+
+    def _remove_segment(self, base):
+        for ext in ('log', 'idx'):
+            path = self._file(base, ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _segment(self, seq) -> int:
+        return seq - seq % self.SegmentSize
+
+    def _file(self, base, ext) -> str:
+        return os.path.join(self.path, '%020d.%s' % (base, ext))
+
+
+class OfflineStore(object):
+    """
+        磁盘持久化的离线消息存储, 重启后不会丢失
+        每个用户一个只追加的信箱, 超过limit条时淘汰最旧的消息
+        key必须是纯数字的用户ID, 否则抛出ValueError
+        本类不加锁, 同一用户的操作需要调用者保证互斥
+    """
+    def __init__(self, base_dir='./database/offline', limit=1000):
+        self._base_dir = base_dir
+        self._limit = limit
+        self._mailboxes = {}
+
+    def append(self, key: str, data: bytes):
+        """ 保存一条离线消息 """
+        box = self._mailbox(key)
+        self._mailboxes[key] = box
+        box.append(data)
+        if len(box) > self._limit:
+            box.trim(box.tail - self._limit)
+
+    def pending(self, key: str) -> int:
+        """ 未投递的消息数量 """
+        return len(self._mailbox(key))
+
+    def total_pending(self) -> int:
+        """ 所有已加载信箱的未投递消息数, 启动后还没有访问过的信箱不计入 """
+        return sum(len(box) for box in list(self._mailboxes.values()))
+
+    def end(self, key: str) -> int:
+        """ 下一条消息的序号 """
+        return self._mailbox(key).tail
+
+    def read(self, key: str, start=0, count=None):
+        """ 按顺序读取消息, 返回 (序号, 消息) 的生成器, 不会一次性加载到内存 """
+        box = self._mailbox(key)
+        if count is None:
+            count = len(box)
+        return box.read(start, count)
+
+    def trim(self, key: str, upto: int):
+        """ 确认序号小于upto的消息已经投递 """
+        box = self._mailbox(key)
+        box.trim(upto)
+        if not len(box):
+            self._mailboxes.pop(key, None)
+
+    def _mailbox(self, key: str) -> _Mailbox:
+        box = self._mailboxes.get(key)
+        if box is None:
+            # key用作目录名, 只接受用户ID, 防止 '../' 等写到存储目录之外
+            if not isinstance(key, str) or not key.isdigit():
+                raise ValueError('offline key error: %r' % (key,))
+            # 按ID末两位分目录, 避免单个目录下文件过多
+            box = _Mailbox(os.path.join(self._base_dir, key[-2:], key))
+            if len(box):
+                self._mailboxes[key] = box
+        return box
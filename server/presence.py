@@ -0,0 +1,86 @@
+from threading import Condition, Lock, Thread
+from global_manager import GlobalManger
+from message import *
+from user import User
+from log import get_logger
+import time
+
+logger = get_logger('presence')
+
+
+class Presence(object):
+    """
+        好友上线/下线通知服务
+        用户状态变化时只做记录, 由后台线程每Window秒合并后统一通知
+        同一窗口内多次变化只通知最后的状态, 状态最终没有改变则不通知
+        只通知在线的好友, 通过GlobalManger按分片批量投递
+    """
+    __instance = None
+    __inited = False
+    _l = Lock()
+    # 合并窗口, 单位秒
+    Window = 0.2
+
+    def __new__(cls, *args, **kwargs):
+        if not cls.__instance:
+            cls.__instance = super().__new__(cls)
+        return cls.__instance
+
+    def __init__(self):
+        self._l.acquire()
+        if not self.__inited:
+            self.__inited = True
+            self.__running = True
+            self.__cond = Condition(Lock())
+            # ID -> [用户, 窗口开始前的状态, 最新状态]
+            self.__pending = {}
+            self.__thread = Thread(target=self.__flush_loop, name='presence', daemon=True)
+            self.__thread.start()
+        self._l.release()
+
+    def changed(self, user: User, online: bool):
+        """ 记录用户状态变化 """
+        with self.__cond:
+            change = self.__pending.get(user.ID)
+            if change is None:
+                self.__pending[user.ID] = [user, not online, online]
+                self.__cond.notify()
+            else:
+                change[0] = user
+                change[2] = online
+
+    def close(self):
+        """ 停止后台线程, 未发送的通知直接丢弃 """
+        with self.__cond:
+            self.__running = False
+            self.__pending.clear()
+            self.__cond.notify()
+
+    def __flush_loop(self):
+        while True:
+            with self.__cond:
+                while self.__running and not self.__pending:
+                    self.__cond.wait()
+                if not self.__running:
+                    return
+            # 等待窗口结束, 窗口内的变化都会被合并
+            time.sleep(self.Window)
+            with self.__cond:
+                pending, self.__pending = self.__pending, {}
+            for user, before, online in pending.values():
+                if before == online:
+                    continue
+                try:
+                    self.__publish(user, online)
+                except Exception:
+                    logger.exception('publish presence of %s error', user.ID)
+
+    @staticmethod
+    def __publish(user: User, online: bool):
+        """ 通知所有在线好友 """
+        msg = RetOnlineNotifyMsg(RetOnlineNotifyMsg.DefaultMsg)
+        # 此处是自己的ID，告诉朋友自己上线了
+        msg.friend_id = user.ID
+        msg.nick_name = user.nick_name
+        msg.online = online
+        GlobalManger().send_msg2ids(list(user.friend_ids()), msg, save_offline=False)
@@ -0,0 +1,796 @@
+from threading import Event, Lock, Thread
+from framing import FrameDecoder
+from message import *
+from offline_store import OfflineStore
+from log import get_logger
+import codec
+import hashlib
+import hmac
+import itertools
+import os
+import queue
+import socket
+import time
+import zlib
+
+"""
+    跨进程的消息路由
+    GlobalManger只管理本进程的连接, 不在本进程的用户交给路由处理
+        LocalRouter     单进程模式, 不在本进程即为离线, 直接保存离线消息
+        BrokerRouter    多进程模式的工作进程, 通过Unix socket连接主进程中的Broker
+        Broker          运行在主进程中, 记录用户所在的工作进程, 转发消息并统一保存离线消息
+        ClusterRouter   集群模式, 节点之间通过TCP连接直接转发, 离线消息保存在用户的归属节点
+"""
+
+__all__ = ['Link', 'LocalRouter', 'BrokerRouter', 'Broker', 'ClusterRouter']
+
+logger = get_logger('router')
+
+# 转发的消息除了请求消息外, 还有服务器生成的上下线通知等响应消息
+_ForwardTypes = {cls.DefaultMsg['cmd']: cls for cls in Message.__subclasses__()}
+
+
+def restore_msg(msg_json: str) -> Message:
+    """ 还原其他进程转发来的消息 """
+    msg_dict = codec.loads(msg_json)
+    cls = _ForwardTypes.get(msg_dict.get('cmd'))
+    if cls is None:
+        raise ValueError('message command error')
+    return cls(msg_dict)
+
+
+class Link(object):
+    """
+        进程之间的消息通道, 每条消息是一个JSON数组 [操作, 参数...], 使用长度前缀分帧
+        发送只放入队列由写线程发出, 调用者不会因为对方处理慢而阻塞
+        收到的消息在读线程中回调 on_message(link, items)
+    """
+    RecvSize = 65536
+    # 写线程每次最多合并发送的消息数
+    SendBatch = 64
+
+    def __init__(self, sock: socket.socket, on_message, on_close=None, name='link'):
+        self.name = name
+        # 对端的编号, 由握手消息确定
+        self.peer = None
+        self.closed = False
+        self._sock = sock
+        self._on_message = on_message
+        self._on_close = on_close
+        self._decoder = FrameDecoder()
+        self._out = queue.Queue()
+        self._writer = None
+
+    def start(self):
+        self._writer = Thread(target=self._write_loop, name=self.name + '-write', daemon=True)
+        self._writer.start()
+        Thread(target=self._read_loop, name=self.name + '-read', daemon=True).start()
+
+    def send(self, *items):
+        if not self.closed:
+            self._out.put(self._decoder.pack(codec.dumpb(items)))
+
+    def close(self):
+        """ 队列中已有的消息发送完后断开连接 """
+        if self.closed:
+            return
+        self.closed = True
+        self._out.put(None)
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            chunks = [self._out.get()]
+            while chunks[-1] is not None and len(chunks) < self.SendBatch and not self._out.empty():
+                chunks.append(self._out.get_nowait())
+            stop = chunks[-1] is None
+            try:
+                self._sock.sendall(b''.join(c for c in chunks if c is not None))
+            except OSError as e:
+                logger.debug('%s send error: %s', self.name, e)
+                self.closed = True
+                break
+        # 唤醒读线程
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _read_loop(self):
+        try:
+            while True:
+                data = self._sock.recv(self.RecvSize)
+                if not data:
+                    break
+                for frame in self._decoder.feed(data):
+                    try:
+                        self._on_message(self, codec.loads(frame))
+                    except Exception:
+                        logger.exception('%s handle message error', self.name)
+        except (OSError, ValueError) as e:
+            logger.debug('%s recv error: %s', self.name, e)
+        finally:
+            self.close()
+            self._writer.join(1.0)
+            self._sock.close()
+            if self._on_close:
+                self._on_close(self)
+
+
+class LocalRouter(object):
+    """ 单进程模式, 所有用户都连接在本进程, 不在本进程的用户即为离线 """
+    def __init__(self, offline_dir: str, offline_limit: int):
+        # 离线消息存储, 用户离线时只有持有分片锁的route追加, 上线后只有自己的连接读取和确认, 同一用户的操作不会并发
+        self.offline = OfflineStore(offline_dir, offline_limit)
+
+    def start(self, deliver):
+        pass
+
+    def close(self):
+        pass
+
+    def user_online(self, id_):
+        pass
+
+    def user_offline(self, id_):
+        pass
+
+    def is_online(self, id_) -> bool:
+        return False
+
+    def route(self, ids, msg: Message, save_offline: bool):
+        """ 投递给不在本进程的用户, 调用者持有ids所在分片的锁 """
+        if save_offline:
+            data = msg.msg_json_bytes
+            for id_ in ids:
+                self.offline.append(id_, data)
+
+
+class _RemoteOffline(object):
+    """ 与OfflineStore的接口相同, 实际由Broker中的OfflineStore执行 """
+    def __init__(self, router):
+        self._router = router
+
+    def append(self, key: str, data: bytes):
+        self._router.call('append', key, data.decode('utf-8'))
+
+    def pending(self, key: str) -> int:
+        return self._router.call('pending', key)
+
+    def total_pending(self) -> int:
+        return self._router.call('total_pending')
+
+    def end(self, key: str) -> int:
+        return self._router.call('end', key)
+
+    def read(self, key: str, start=0, count=None):
+        return [(seq, data.encode('utf-8')) for seq, data in self._router.call('read', key, start, count)]
+
+    def trim(self, key: str, upto: int):
+        self._router.call('trim', key, upto)
+
+
+class BrokerRouter(object):
+    """
+        多进程模式下工作进程的路由
+        其他工作进程的在线用户由Broker广播, 本地保存一份副本, is_online不需要等待
+        发给不在本进程的用户的消息交给Broker, 由Broker转发或保存为离线消息
+        Broker转发来的消息由单独的线程投递, 投递时等待分片锁不会耽误接收Broker的回复
+    """
+    # 等待Broker回复的最长时间
+    CallTimeout = 10.0
+
+    def __init__(self, path: str, worker: int, on_lost=None):
+        """ on_lost在与Broker的连接意外断开时调用, 此时已无法转发消息, 工作进程应当退出 """
+        self.offline = _RemoteOffline(self)
+        self._path = path
+        self._worker = worker
+        # 其他工作进程中在线的用户 ID -> 工作进程编号
+        self._remote = {}
+        self._calls = {}
+        self._call_ids = itertools.count()
+        self._ready = Event()
+        self._inbox = queue.Queue()
+        self._deliver = None
+        self._link = None
+        self._closing = False
+        self._on_lost = on_lost
+
+    def start(self, deliver):
+        """ 连接Broker并等待在线用户表, deliver(ids, msg, save_offline)用于投递转发来的消息 """
+        self._deliver = deliver
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.time() + self.CallTimeout
+        while True:
+            try:
+                sock.connect(self._path)
+                break
+            except OSError:
+                # 主进程可能还没有开始接受连接
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        Thread(target=self._deliver_loop, name='broker-deliver', daemon=True).start()
+        self._link = Link(sock, self._on_message, self._on_close, 'broker')
+        self._link.start()
+        self._link.send('hello', self._worker)
+        if not self._ready.wait(self.CallTimeout):
+            raise ConnectionError('broker not ready')
+
+    def close(self):
+        self._closing = True
+        if self._link:
+            self._link.send('bye')
+            self._link.close()
+        self._inbox.put(None)
+
+    def user_online(self, id_):
+        self._link.send('online', id_)
+
+    def user_offline(self, id_):
+        self._link.send('offline', id_)
+
+    def is_online(self, id_) -> bool:
+        return id_ in self._remote
+
+    def route(self, ids, msg: Message, save_offline: bool):
+        """ 只放入发送队列, 可以在持有分片锁时调用 """
+        if not save_offline:
+            # 不保存离线消息时, 不在线的用户不需要经过Broker
+            ids = [id_ for id_ in ids if id_ in self._remote]
+        if ids:
+            self._link.send('deliver', ids, msg.msg_json, save_offline)
+
+    def call(self, method: str, *args):
+        """ 请求Broker执行离线消息存储的操作并等待结果 """
+        req_id = next(self._call_ids)
+        call = self._calls[req_id] = [Event(), None]
+        self._link.send('call', req_id, method, args)
+        if not call[0].wait(self.CallTimeout):
+            self._calls.pop(req_id, None)
+            raise ConnectionError('broker call %s timeout' % method)
+        if isinstance(call[1], Exception):
+            raise call[1]
+        return call[1]
+
+    def _on_message(self, link: Link, items: list):
+        op = items[0]
+        if op == 'deliver':
+            self._inbox.put(items[1:])
+        elif op == 'online':
+            self._remote[items[1]] = items[2]
+        elif op == 'offline':
+            self._remote.pop(items[1], None)
+        elif op == 'reply':
+            call = self._calls.pop(items[1], None)
+            if call:
+                call[1] = items[3] and RuntimeError(items[3]) or items[2]
+                call[0].set()
+        elif op == 'snapshot':
+            self._remote.update(items[1])
+            self._ready.set()
+        else:
+            logger.warning('unknown broker message %s', op)
+
+    def _on_close(self, link: Link):
+        if not self._closing:
+            logger.error('broker connection lost')
+        error = ConnectionError('broker connection lost')
+        for call in list(self._calls.values()):
+            call[1] = error
+            call[0].set()
+        self._calls.clear()
+        self._remote.clear()
+        if not self._closing and self._on_lost:
+            self._on_lost()
+
+    def _deliver_loop(self):
+        while True:
+            item = self._inbox.get()
+            if item is None:
+                return
+            ids, msg_json, save_offline = item
+            try:
+                self._deliver(ids, restore_msg(msg_json), save_offline)
+            except Exception:
+                logger.exception('deliver to %s error', ids)
+
+
+class Broker(object):
+    """
+        多进程模式下运行在主进程中, 工作进程通过Unix socket连接
+        记录每个用户连接在哪个工作进程, 上下线时广播给其他工作进程
+        收到发给其他进程用户的消息时转发, 用户不在线则保存为离线消息
+        所有操作在同一把锁内执行, 不会出现保存离线消息之后用户才登记上线的情况
+    """
+    # 工作进程可以调用的离线消息存储操作
+    Calls = ('append', 'pending', 'total_pending', 'end', 'read', 'trim')
+
+    def __init__(self, path: str, offline_dir: str, offline_limit: int):
+        if os.path.exists(path):
+            os.remove(path)
+        self._path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen()
+        self._l = Lock()
+        self._running = True
+        # 工作进程编号 -> Link
+        self._links = {}
+        # 用户ID -> 工作进程编号
+        self._users = {}
+        self._offline_dir = offline_dir
+        self._offline_limit = offline_limit
+        self._offline = None
+
+    def detach(self):
+        """ fork出的工作进程关闭继承的监听socket """
+        self._running = False
+        self._sock.close()
+
+    def start(self):
+        """ 在后台线程中接受工作进程的连接 """
+        # fork之后才创建, 工作进程中不会残留信箱缓存
+        self._offline = OfflineStore(self._offline_dir, self._offline_limit)
+        Thread(target=self._accept_loop, name='broker', daemon=True).start()
+
+    def close(self):
+        self._running = False
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        with self._l:
+            links = list(self._links.values())
+        for link in links:
+            link.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                if self._running:
+                    logger.exception('broker accept error')
+                return
+            Link(sock, self._on_message, self._on_close, 'worker').start()
+
+    def _on_message(self, link: Link, items: list):
+        op = items[0]
+        with self._l:
+            if op == 'deliver':
+                self._route(items[1], items[2], items[3])
+            elif op == 'online':
+                self._users[items[1]] = link.peer
+                self._broadcast(link.peer, 'online', items[1], link.peer)
+            elif op == 'offline':
+                # 用户可能已经在其他进程重新登陆
+                if self._users.get(items[1]) == link.peer:
+                    del self._users[items[1]]
+                    self._broadcast(link.peer, 'offline', items[1])
+            elif op == 'call':
+                self._call(link, items[1], items[2], items[3])
+            elif op == 'bye':
+                self._remove_worker(link)
+                logger.info('worker %d exit', link.peer)
+            elif op == 'hello':
+                link.peer = items[1]
+                link.name = 'worker%d' % link.peer
+                self._links[link.peer] = link
+                link.send('snapshot', self._users)
+                logger.info('worker %d connected', link.peer)
+            else:
+                logger.warning('unknown worker message %s', op)
+
+    def _on_close(self, link: Link):
+        with self._l:
+            gone = self._remove_worker(link)
+        if gone is not None:
+            logger.warning('worker %s disconnected, %d users offline', link.peer, len(gone))
+
+    def _remove_worker(self, link: Link):
+        """ 工作进程退出, 其上的用户全部下线, 返回下线的用户, 已经移除过返回None """
+        if self._links.get(link.peer) is not link:
+            return None
+        del self._links[link.peer]
+        gone = [id_ for id_, worker in self._users.items() if worker == link.peer]
+        for id_ in gone:
+            del self._users[id_]
+            self._broadcast(link.peer, 'offline', id_)
+        return gone
+
+    def _route(self, ids, msg_json: str, save_offline: bool):
+        targets = {}
+        for id_ in ids:
+            worker = self._users.get(id_)
+            if worker in self._links:
+                targets.setdefault(worker, []).append(id_)
+            elif save_offline:
+                self._offline.append(id_, msg_json.encode('utf-8'))
+        # 转发目标可能就是发送方, 用户刚刚下线时由发送方重新路由
+        for worker, id_list in targets.items():
+            self._links[worker].send('deliver', id_list, msg_json, save_offline)
+
+    def _call(self, link: Link, req_id: int, method: str, args: list):
+        result = error = None
+        try:
+            if method not in self.Calls:
+                raise ValueError('unknown call %s' % method)
+            if method == 'append':
+                args = [args[0], args[1].encode('utf-8')]
+            result = getattr(self._offline, method)(*args)
+            if method == 'read':
+                result = [(seq, data.decode('utf-8')) for seq, data in result]
+        except Exception as e:
+            logger.exception('broker call %s error', method)
+            error = str(e)
+        link.send('reply', req_id, result, error)
+
+    def _broadcast(self, source, *items):
+        for worker, link in self._links.items():
+            if worker != source:
+                link.send(*items)
+
+
+# 节点之间每种消息的参数格式, 'id'为用户ID, 'ids'为用户ID列表, None表示不检查
+_NodeFormats = {
+    'hello': (int, str),
+    'deliver': ('ids', str, bool),
+    'reply': (int, None),
+    'online': ('id',),
+    'offline': ('id',),
+    'store': ('ids', str),
+    'pull': (int, 'id'),
+    'trim': ('id', int),
+    'snapshot': ('ids',),
+}
+
+
+def _is_id(value) -> bool:
+    """ 用户ID是纯数字的字符串, 离线消息用它作为目录名 """
+    return isinstance(value, str) and value.isdigit()
+
+
+def _check_items(items: list) -> bool:
+    """ 检查其他节点发来的消息格式, 避免错误的参数进入在线表和离线存储 """
+    if not isinstance(items, list) or not items or not isinstance(items[0], str):
+        return False
+    fmt = _NodeFormats.get(items[0])
+    if fmt is None or len(items) != len(fmt) + 1:
+        return False
+    for kind, value in zip(fmt, items[1:]):
+        if kind == 'id':
+            ok = _is_id(value)
+        elif kind == 'ids':
+            ok = isinstance(value, list) and all(_is_id(id_) for id_ in value)
+        else:
+            ok = kind is None or isinstance(value, kind)
+        if not ok:
+            return False
+    return True
+
+
+class _LockedOffline(object):
+    """ 集群节点的本地离线消息存储, 其他节点保存和拉取时也会访问, 所有操作都加锁 """
+    def __init__(self, store: OfflineStore, lock):
+        self._store = store
+        self._l = lock
+
+    def append(self, key: str, data: bytes):
+        with self._l:
+            self._store.append(key, data)
+
+    def pending(self, key: str) -> int:
+        with self._l:
+            return self._store.pending(key)
+
+    def total_pending(self) -> int:
+        with self._l:
+            return self._store.total_pending()
+
+    def end(self, key: str) -> int:
+        with self._l:
+            return self._store.end(key)
+
+    def read(self, key: str, start=0, count=None):
+        with self._l:
+            return list(self._store.read(key, start, count))
+
+    def trim(self, key: str, upto: int):
+        with self._l:
+            self._store.trim(key, upto)
+
+
+class ClusterRouter(object):
+    """
+        集群模式的路由, 每个节点是一个独立的服务器, 节点列表在启动时指定
+        节点之间每个方向一条TCP连接: 本节点只在主动建立的连接上发送, 在接受的连接上接收
+        每个节点把自己用户的上下线发给其他节点, 各自维护 用户->节点 的在线表
+        发给其他节点用户的消息直接发到该节点, 对方已经下线时由该节点重新路由
+        不在任何节点在线的用户, 离线消息保存在其归属节点:
+            按ID对所有节点做一致的哈希排序, 第一个可以连接的节点为归属节点
+            归属节点收到消息时用户如果已经在其他节点上线, 直接转发
+        用户登陆时从所有可以连接的节点拉取其离线消息到本节点, 之后按单机的方式分页同步
+        连接建立后先发送hello, 带有用集群密钥对节点编号做的HMAC, 验证失败或握手前发送其他消息的连接直接断开
+        节点之间的数据没有加密, 节点端口只应该在可信的网络中开放
+    """
+    # 等待其他节点回复的最长时间
+    CallTimeout = 3.0
+    # 连接断开后重连的间隔
+    RetryInterval = 1.0
+
+    def __init__(self, node: int, nodes: list, secret: str, offline_dir: str, offline_limit: int):
+        """ nodes为所有节点的 (host, port), node为本节点在其中的位置, secret为所有节点共用的密钥 """
+        if not secret:
+            raise ValueError('cluster secret is required')
+        self.node = node
+        self._nodes = nodes
+        self._secret = secret.encode('utf-8')
+        self._l = Lock()
+        self._store = OfflineStore(offline_dir, offline_limit)
+        self.offline = _LockedOffline(self._store, self._l)
+        # 本节点在线的用户
+        self._local = set()
+        # 其他节点在线的用户 ID -> 节点编号
+        self._directory = {}
+        # 节点编号 -> 本节点主动建立的连接, 只包含已连接的节点
+        self._links = {}
+        # 节点编号 -> 其他节点连接过来的连接
+        self._inbound = {}
+        self._calls = {}
+        self._call_ids = itertools.count()
+        self._inbox = queue.Queue()
+        self._deliver = None
+        self._running = False
+        self._sock = None
+
+    @staticmethod
+    def parse_nodes(spec: str) -> list:
+        """ 解析 "host:port,host:port" 形式的节点列表 """
+        nodes = []
+        for item in spec.split(','):
+            host, sep, port = item.strip().rpartition(':')
+            if not sep or not host:
+                raise ValueError('node address format error: %s' % item)
+            nodes.append((host, int(port)))
+        return nodes
+
+    def start(self, deliver):
+        """ 监听本节点地址并连接其他节点, 其他节点可以稍后再启动 """
+        self._deliver = deliver
+        self._running = True
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 节点重启后可以立即重新监听
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(self._nodes[self.node])
+        self._sock.listen()
+        Thread(target=self._accept_loop, name='cluster', daemon=True).start()
+        Thread(target=self._deliver_loop, name='cluster-deliver', daemon=True).start()
+        for node in range(len(self._nodes)):
+            if node != self.node:
+                Thread(target=self._dial_loop, args=(node,), name='dial%d' % node, daemon=True).start()
+        logger.info('node %d listening on %s:%d', self.node, *self._nodes[self.node])
+
+    def close(self):
+        self._running = False
+        if self._sock:
+            # 只close不会唤醒阻塞在accept的线程, 监听也不会停止
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+        with self._l:
+            links = list(self._links.values()) + list(self._inbound.values())
+        for link in links:
+            link.close()
+        self._inbox.put(None)
+
+    def user_online(self, id_):
+        """ 通知其他节点, 并拉取该用户保存在其他节点的离线消息 """
+        with self._l:
+            self._local.add(id_)
+            self._broadcast('online', id_)
+        self._pull(id_)
+
+    def user_offline(self, id_):
+        with self._l:
+            self._local.discard(id_)
+            self._broadcast('offline', id_)
+
+    def is_online(self, id_) -> bool:
+        return self._directory.get(id_) in self._links
+
+    def route(self, ids, msg: Message, save_offline: bool):
+        """ 只放入各连接的发送队列, 可以在持有分片锁时调用 """
+        delivers = {}
+        stores = {}
+        with self._l:
+            for id_ in ids:
+                node = self._directory.get(id_)
+                if node in self._links:
+                    delivers.setdefault(node, []).append(id_)
+                elif save_offline:
+                    home = self._home(id_)
+                    if home == self.node:
+                        self._store.append(id_, msg.msg_json_bytes)
+                    else:
+                        stores.setdefault(home, []).append(id_)
+            for node, id_list in delivers.items():
+                self._links[node].send('deliver', id_list, msg.msg_json, save_offline)
+            for node, id_list in stores.items():
+                self._links[node].send('store', id_list, msg.msg_json)
+
+    def _home(self, id_) -> int:
+        """ 用户的归属节点, 调用者持有锁 """
+        order = sorted(range(len(self._nodes)), reverse=True,
+                       key=lambda node: zlib.crc32(('%d:%s' % (node, id_)).encode('utf-8')))
+        for node in order:
+            if node == self.node or node in self._links:
+                return node
+        return self.node
+
+    def _pull(self, id_):
+        """ 同时向所有节点请求, 收到后保存到本节点, 再通知对方删除 """
+        with self._l:
+            links = list(self._links.values())
+        calls = [(link, self._call(link, 'pull', id_)) for link in links]
+        for link, (req_id, call) in calls:
+            if not call[0].wait(self.CallTimeout):
+                self._calls.pop(req_id, None)
+                logger.warning('pull offline of %s from node %d timeout', id_, link.peer)
+                continue
+            end, msgs = call[1]
+            if not msgs:
+                continue
+            with self._l:
+                for data in msgs:
+                    self._store.append(id_, data.encode('utf-8'))
+            link.send('trim', id_, end)
+
+    def _call(self, link: Link, op: str, *args):
+        """ 发送请求, 返回 (请求编号, [Event, 结果]), 结果由接收线程填入 """
+        req_id = next(self._call_ids)
+        call = self._calls[req_id] = [Event(), None]
+        link.send(op, req_id, *args)
+        return req_id, call
+
+    def _broadcast(self, *items):
+        """ 调用者持有锁, 保证与握手时发送的在线用户表顺序一致 """
+        for link in self._links.values():
+            link.send(*items)
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                if self._running:
+                    logger.exception('cluster accept error')
+                return
+            Link(sock, self._on_message, self._on_inbound_close, 'node').start()
+
+    def _dial_loop(self, node: int):
+        """ 保持到node的连接, 断开后重连, 连上后先发送本节点的在线用户表 """
+        while self._running:
+            try:
+                sock = socket.create_connection(self._nodes[node], self.CallTimeout)
+                sock.settimeout(None)
+            except OSError:
+                time.sleep(self.RetryInterval)
+                continue
+            closed = Event()
+            link = Link(sock, lambda link, items: None, lambda link: closed.set(), 'node%d' % node)
+            link.peer = node
+            link.start()
+            with self._l:
+                link.send('hello', self.node, self._hello_digest(self.node, node))
+                link.send('snapshot', list(self._local))
+                self._links[node] = link
+            logger.info('connected to node %d', node)
+            closed.wait()
+            with self._l:
+                if self._links.get(node) is link:
+                    del self._links[node]
+            if self._running:
+                logger.warning('lost connection to node %d', node)
+                time.sleep(self.RetryInterval)
+
+    def _on_inbound_close(self, link: Link):
+        with self._l:
+            if link.peer is None or self._inbound.get(link.peer) is not link:
+                return
+            del self._inbound[link.peer]
+            self._drop_node(link.peer)
+
+    def _drop_node(self, node: int):
+        """ 删除在线表中node的用户, 调用者持有锁 """
+        for id_ in [id_ for id_, n in self._directory.items() if n == node]:
+            del self._directory[id_]
+
+    def _hello_digest(self, src: int, dst: int) -> str:
+        """ 节点src连接dst时的握手签名, 包含双方编号, 不能用于连接其他节点 """
+        data = ('hello:%d:%d' % (src, dst)).encode('utf-8')
+        return hmac.new(self._secret, data, hashlib.sha256).hexdigest()
+
+    def _on_message(self, link: Link, items: list):
+        if not _check_items(items):
+            logger.warning('%s bad message, drop', link.name)
+            link.close()
+            return
+        op = items[0]
+        # 握手之前只接受hello, 验证失败的连接直接断开
+        if link.peer is None and (op != 'hello' or not self._check_hello(items)):
+            logger.warning('%s handshake failed, drop', link.name)
+            link.close()
+            return
+        if op == 'deliver':
+            self._inbox.put(items[1:])
+        elif op == 'reply':
+            call = self._calls.pop(items[1], None)
+            if call:
+                call[1] = items[2]
+                call[0].set()
+        else:
+            with self._l:
+                self._on_locked_message(link, op, items)
+
+    def _on_locked_message(self, link: Link, op: str, items: list):
+        if op == 'online':
+            self._directory[items[1]] = link.peer
+        elif op == 'offline':
+            # 用户可能已经在其他节点重新登陆
+            if self._directory.get(items[1]) == link.peer:
+                del self._directory[items[1]]
+        elif op == 'store':
+            self._store_msg(items[1], items[2])
+        elif op == 'pull':
+            reply = self._links.get(link.peer)
+            msgs = list(self._store.read(items[2]))
+            if reply:
+                reply.send('reply', items[1], [self._store.end(items[2]), [data.decode('utf-8') for _, data in msgs]])
+        elif op == 'trim':
+            self._store.trim(items[1], items[2])
+        elif op == 'snapshot':
+            # 重新连接的节点发来完整的在线用户表, 替换之前的记录
+            self._drop_node(link.peer)
+            for id_ in items[1]:
+                self._directory[id_] = link.peer
+        elif op == 'hello' and link.peer is None:
+            link.peer = items[1]
+            link.name = 'node%d' % link.peer
+            old = self._inbound.get(link.peer)
+            self._inbound[link.peer] = link
+            if old:
+                old.close()
+
+    def _check_hello(self, items: list) -> bool:
+        node, digest = items[1], items[2]
+        if node == self.node or not 0 <= node < len(self._nodes):
+            return False
+        return hmac.compare_digest(digest, self._hello_digest(node, self.node))
+
+    def _store_msg(self, ids, msg_json: str):
+        """ 作为归属节点保存离线消息, 用户已经上线时改为转发, 调用者持有锁 """
+        for id_ in ids:
+            node = self._directory.get(id_)
+            if id_ in self._local:
+                self._inbox.put(([id_], msg_json, True))
+            elif node in self._links:
+                self._links[node].send('deliver', [id_], msg_json, True)
+            else:
+                self._store.append(id_, msg_json.encode('utf-8'))
+
+    def _deliver_loop(self):
+        while True:
+            item = self._inbox.get()
+            if item is None:
+                return
+            ids, msg_json, save_offline = item
+            try:
+                self._deliver(ids, restore_msg(msg_json), save_offline)
+            except Exception:
+                logger.exception('deliver to %s error', ids)
@@ -0,0 +1,89 @@
+import heapq
+
+__all__ = ['NGramIndex']
+
+
+class NGramIndex(object):
+    """
+        子串查找用的n-gram倒排索引
+        每个字符串按1到N个字符切分为gram, 每个gram记录包含它的key集合
+        查找时取查询串中包含key最少的gram, 只在这个集合中逐个确认子串, 不需要遍历全部key
+        结果按key排序, 只保留前offset+limit个, 分页时不会重复或遗漏
+        本类修改时不加锁, 由调用者保证互斥, 查找可以和修改并发
+    """
+    N = 3
+
+    def __init__(self):
+        self._postings = {}
+        self._texts = {}
+
+    def __len__(self):
+        return len(self._texts)
+
+    def get(self, key):
+        """ 返回key当前被索引的字符串 """
+        return self._texts.get(key)
+
+    def add(self, key, text: str):
+        """ 索引key对应的字符串, key已存在时替换原来的字符串 """
+        old = self._texts.get(key)
+        if old == text:
+            return
+        if old is not None:
+            self.remove(key)
+        self._texts[key] = text
+        for gram in self._grams(text):
+            posting = self._postings.get(gram)
+            if posting is None:
+                posting = self._postings[gram] = set()
+            posting.add(key)
+
+    def remove(self, key):
+        """ 删除key的索引 """
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        for gram in self._grams(text):
+            posting = self._postings.get(gram)
+            if posting is None:
+                continue
+            posting.discard(key)
+            if not posting:
+                del self._postings[gram]
+
+    def search(self, query: str, limit=None, offset=0, match=None, retry=3) -> list:
+        """
+            返回字符串中包含query的key, 按key排序后跳过前offset个, 最多返回limit个
+            match不为None时只返回match(key)为真的key, 在计算offset和limit之前过滤
+        """
+        if not query:
+            return []
+        for _ in range(retry):
+            try:
+                return self._search(query, limit, offset, match)
+            except RuntimeError:
+                # Set changed size during iteration
+                continue
+        return self._search(query, limit, offset, match)
+
+    def _search(self, query, limit, offset, match):
+        grams = [query[i:i + self.N] for i in range(max(len(query) - self.N, 0) + 1)]
+        postings = []
+        for gram in grams:
+            posting = self._postings.get(gram)
+            if not posting:
+                return []
+            postings.append(posting)
+        candidates = min(postings, key=len)
+        # 查询串不超过N个字符时候选集合就是结果, 否则需要确认是否为子串
+        exact = len(query) <= self.N
+        texts = self._texts
+        keys = (key for key in candidates
+                if (exact or query in texts.get(key, '')) and (match is None or match(key)))
+        # 集合的遍历顺序会随修改变化, 排序后分页才稳定
+        if limit is None:
+            return sorted(keys)[offset:]
+        return heapq.nsmallest(offset + limit, keys)[offset:]
+
+    def _grams(self, text: str) -> set:
+        return {text[i:i + n] for n in range(1, self.N + 1) for i in range(len(text) - n + 1)}
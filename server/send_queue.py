@@ -0,0 +1,115 @@
+from collections import deque
+import threading
+
+__all__ = ['SendQueue']
+
+
+class SendQueue(object):
+    """
+        每个连接独立的有界发送队列
+        put只把数据放入队列, 不操作socket, 由连接自己的写线程/写协程取出发送
+        队列满时按策略处理慢速的接收方:
+            drop        丢弃新消息
+            disconnect  关闭队列, 由连接断开慢速客户端
+            block       阻塞发送方直到队列有空位(超时则断开)
+    """
+    Drop = 'drop'
+    Disconnect = 'disconnect'
+    Block = 'block'
+    Policies = (Drop, Disconnect, Block)
+
+    def __init__(self, maxsize=1024, policy=Drop, timeout=5.0, notify=None):
+        if policy not in self.Policies:
+            raise ValueError('unknown send queue policy %s' % policy)
+        self._q = deque()
+        self._maxsize = maxsize
+        self._policy = policy
+        self._timeout = timeout
+        self._closed = False
+        # 是否因为接收方太慢而被关闭
+        self._overflow = False
+        self._cond = threading.Condition(threading.Lock())
+        # 队列由空变为非空时回调, 用于唤醒写协程
+        self._notify = notify
+        self.dropped = 0
+
+    def put(self, data: bytes, block=True) -> bool:
+        """
+            放入一条待发送数据, 返回是否入队成功
+            block为False时, block策略不等待, 直接超出上限入队, 由调用者负责反压
+        """
+        with self._cond:
+            if self._closed:
+                return False
+            if len(self._q) >= self._maxsize:
+                if self._policy == self.Drop:
+                    self.dropped += 1
+                    return False
+                if self._policy == self.Disconnect:
+                    self._close(overflow=True)
+                    return False
+                if block and not self._cond.wait_for(self._can_put, self._timeout):
+                    # 等待超时，接收方长时间不读取数据, 断开
+                    self._close(overflow=True)
+                    return False
+                if self._closed:
+                    return False
+            self._q.append(data)
+            wakeup = len(self._q) == 1
+            self._cond.notify_all()
+        if wakeup and self._notify:
+            self._notify()
+        return True
+
+    def get_all(self, timeout=None):
+        """ 阻塞取出所有数据, 队列关闭且为空时返回None """
+        with self._cond:
+            self._cond.wait_for(lambda: self._q or self._closed, timeout)
+            if not self._q:
+                return None if self._closed else []
+            return self._pop_all()
+
+    def pop_all(self) -> list:
+        """ 非阻塞取出所有数据 """
+        with self._cond:
+            return self._pop_all()
+
+    def close(self):
+        with self._cond:
+            self._close()
+        if self._notify:
+            self._notify()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def overflow(self) -> bool:
+        return self._overflow
+
+    @property
+    def policy(self) -> str:
+        return self._policy
+
+    @property
+    def full(self) -> bool:
+        return len(self._q) >= self._maxsize
+
+    def __len__(self):
+        return len(self._q)
+
+    def _can_put(self) -> bool:
+        return self._closed or len(self._q) < self._maxsize
+
+    def _close(self, overflow=False):
+        self._closed = True
+        self._overflow = self._overflow or overflow
+        self._cond.notify_all()
+
+    def _pop_all(self) -> list:
+        items = list(self._q)
+        self._q.clear()
+        # 唤醒被阻塞的发送方
+        self._cond.notify_all()
+        return items
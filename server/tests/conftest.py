@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服务器的模块直接放在server目录下, 以顶层模块的方式互相导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,158 @@
+"""
+    集群模式的测试, 在127.0.0.1上启动3个ClusterRouter
+    每个路由的deliver回调记录收到的消息, 代替GlobalManger投递给本节点的用户
+"""
+import queue
+import socket
+import time
+
+import pytest
+
+from framing import FrameDecoder
+from message import ChatMsg, RetOnlineNotifyMsg
+from router import ClusterRouter
+import codec
+
+Secret = 'test-secret'
+NodeCount = 3
+
+
+def free_port() -> int:
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_until(cond, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return cond()
+
+
+def chat(from_id: str, to_id: str, text: str) -> ChatMsg:
+    msg = ChatMsg(ChatMsg.DefaultMsg)
+    msg.ID = from_id
+    msg.friend_id = to_id
+    msg.chat = text
+    return msg
+
+
+class Node(object):
+    """ 一个集群节点, 投递给本节点用户的消息放入inbox """
+    def __init__(self, node: int, nodes: list, offline_dir: str):
+        self.inbox = queue.Queue()
+        self.router = ClusterRouter(node, nodes, Secret, offline_dir, 100)
+
+    def start(self):
+        self.router.start(lambda ids, msg, save_offline: self.inbox.put((ids, msg, save_offline)))
+
+    def recv(self, timeout=5.0):
+        return self.inbox.get(timeout=timeout)
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    addrs = [('127.0.0.1', free_port()) for _ in range(NodeCount)]
+    cluster = [Node(i, addrs, str(tmp_path / ('node%d' % i))) for i in range(NodeCount)]
+    for node in cluster:
+        node.start()
+    # 等待所有节点两两连接
+    assert wait_until(lambda: all(len(node.router._links) == NodeCount - 1 for node in cluster))
+    yield cluster
+    for node in cluster:
+        node.router.close()
+
+
+def online(cluster, index: int, id_: str):
+    """ 用户在第index个节点登陆, 等待其他节点都知道 """
+    cluster[index].router.user_online(id_)
+    others = [node for i, node in enumerate(cluster) if i != index]
+    assert wait_until(lambda: all(node.router.is_online(id_) for node in others))
+
+
+def test_chat_reaches_user_on_other_node(nodes):
+    online(nodes, 0, '10000')
+    online(nodes, 1, '10001')
+    nodes[0].router.route(['10001'], chat('10000', '10001', 'hello'), True)
+    ids, msg, save_offline = nodes[1].recv()
+    assert ids == ['10001']
+    assert type(msg) == ChatMsg and msg.chat == 'hello' and msg.ID == '10000'
+    assert save_offline
+    assert nodes[0].inbox.empty() and nodes[2].inbox.empty()
+
+
+def test_presence_reaches_friends_on_other_nodes(nodes):
+    online(nodes, 1, '10001')
+    online(nodes, 2, '10002')
+    notify = RetOnlineNotifyMsg(RetOnlineNotifyMsg.DefaultMsg)
+    notify.friend_id = '10000'
+    notify.online = True
+    # 上下线通知不保存离线消息, 不在线的好友直接跳过
+    nodes[0].router.route(['10001', '10002', '10003'], notify, False)
+    for index, id_ in ((1, '10001'), (2, '10002')):
+        ids, msg, save_offline = nodes[index].recv()
+        assert ids == [id_]
+        assert type(msg) == RetOnlineNotifyMsg and msg.friend_id == '10000' and msg.online
+        assert not save_offline
+    assert all(node.router.offline.pending('10003') == 0 for node in nodes)
+
+
+def test_offline_message_stored_at_home_node(nodes):
+    id_ = '10005'
+    home = nodes[0].router._home(id_)
+    # 所有节点都在线时, 每个节点算出的归属节点相同
+    assert all(node.router._home(id_) == home for node in nodes)
+    sender = (home + 1) % NodeCount
+    nodes[sender].router.route([id_], chat('10000', id_, 'offline'), True)
+    assert wait_until(lambda: nodes[home].router.offline.pending(id_) == 1)
+    assert all(node.router.offline.pending(id_) == 0 for i, node in enumerate(nodes) if i != home)
+
+
+def test_storage_falls_back_when_home_node_is_down(nodes):
+    id_ = '10006'
+    home = nodes[0].router._home(id_)
+    nodes[home].router.close()
+    alive = [i for i in range(NodeCount) if i != home]
+    assert wait_until(lambda: all(home not in nodes[i].router._links for i in alive))
+
+    sender = alive[0]
+    fallback = nodes[sender].router._home(id_)
+    assert fallback in alive
+    nodes[sender].router.route([id_], chat('10000', id_, 'fallback'), True)
+    assert wait_until(lambda: nodes[fallback].router.offline.pending(id_) == 1)
+
+    # 在另一个节点登陆时从后备节点取回离线消息
+    login = alive[1] if fallback == alive[0] else alive[0]
+    nodes[login].router.user_online(id_)
+    offline = nodes[login].router.offline
+    assert offline.pending(id_) == 1
+    data = [data for _, data in offline.read(id_)]
+    assert codec.loads(data[0])['chat'] == 'fallback'
+    assert wait_until(lambda: nodes[fallback].router.offline.pending(id_) == 0)
+
+
+def test_unauthenticated_peer_is_dropped(nodes):
+    addr = nodes[0].router._nodes[0]
+    decoder = FrameDecoder()
+    for items in (['hello', 1, 'bad digest'], ['pull', 1, '10000'], ['pull', 1, '../../escaped']):
+        sock = socket.create_connection(addr, 5)
+        sock.sendall(decoder.pack(codec.dumpb(items)))
+        # 服务端断开连接, 不会回复
+        assert sock.recv(1024) == b''
+        sock.close()
+
+
+def test_invalid_id_from_authenticated_peer_is_dropped(nodes, tmp_path):
+    addr = nodes[0].router._nodes[0]
+    decoder = FrameDecoder()
+    sock = socket.create_connection(addr, 5)
+    hello = ['hello', 1, nodes[0].router._hello_digest(1, 0)]
+    sock.sendall(decoder.pack(codec.dumpb(hello)) + decoder.pack(codec.dumpb(['store', ['../../escaped'], '{}'])))
+    assert sock.recv(1024) == b''
+    sock.close()
+    assert not list(tmp_path.rglob('escaped'))
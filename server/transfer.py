@@ -1,11 +1,25 @@
 from message import *
 from database import Database
 from global_manager import GlobalManger
+from presence import Presence
 from utils import *
 from user import User
+from framing import create_decoder
+from binary_proto import BinaryProto
+from log import get_logger
+from metrics import Counter, Histogram
+from send_queue import SendQueue
 import socket
-import traceback
 import threading
+import time
+
+logger = get_logger('transfer')
+
+# 按命令统计的请求数、处理耗时和失败数
+_CmdNames = {v: k for k, v in vars(Message.Cmd).items() if not k.startswith('_')}
+_requests = Counter('chat_requests_total', '按命令统计的请求数', ('cmd',))
+_errors = Counter('chat_request_errors_total', '按命令统计的处理失败数, 无法解析的消息cmd为invalid', ('cmd',))
+_latency = Histogram('chat_request_seconds', '按命令统计的请求处理耗时', ('cmd',))
 
 
 class Transfer(threading.Thread):
@@ -13,7 +27,16 @@ class Transfer(threading.Thread):
         数据交互类
         维持客户端与服务器的数据交互和客户端的消息转发
     """
-    def __init__(self, sock: socket.socket, name=None):
+    RecvSize = 65536
+    # 断开连接时等待发送队列写完的最长时间
+    SendTimeout = 5.0
+    # 每页离线消息的最大数量
+    OfflinePageSize = 100
+    # 查找好友时最多返回的用户数量
+    FindLimit = 50
+
+    def __init__(self, sock: socket.socket, name=None, legacy=False,
+                 queue_size=1024, queue_policy=SendQueue.Drop):
         super().__init__(name=name)
         self._func_map = {Message.Cmd.Logout: self._logout_msg,
                           Message.Cmd.Chat: self._chat_msg,
@@ -24,50 +47,136 @@ class Transfer(threading.Thread):
                           Message.Cmd.FindFriend: self._find_friend_msg,
                           Message.Cmd.SetInfo: self._set_user_info_msg,
                           Message.Cmd.ModifyPassword: self._modify_password_msg,
-                          Message.Cmd.ReqUserInfo: self._req_user_info_msg}
+                          Message.Cmd.ReqUserInfo: self._req_user_info_msg,
+                          Message.Cmd.SyncOffline: self._sync_offline_msg}
 
         self._sock = sock
         self._peer = self._sock.getpeername()
         self._user = None
         self._req_friend_msg = []
+        # 保护好友请求列表和自己的好友分组, 其他连接的线程也会通过recv_notify修改
+        # 持有时不能再转发消息给其他连接, 否则两个连接互相转发时会死锁
+        self._state_l = threading.RLock()
         self._global_info = GlobalManger()
+        self._presence = Presence()
         self._db = Database.create_db()
         self._be_quit = False
+        # 当前请求是否回复了失败的回执, 用于统计处理失败数
+        self._receipt_failed = False
+        # 连续收到错误消息的次数上限
+        self._retry = 100
+        # legacy为True时使用旧协议, 一次recv即一条消息
+        self._decoder = create_decoder(legacy)
+        # 客户端使用二进制编码时回复也使用二进制编码
+        self._binary = False
+        # 发送队列, 其他连接转发消息时只入队, 由写线程发送, 不会被慢速客户端阻塞
+        self._send_queue = SendQueue(queue_size, queue_policy, notify=self._on_queue_ready)
+        self._write_thread = None
 
     def run(self):
         """ 主循环 """
-        retry = 100
+        self._write_thread = threading.Thread(target=self._write_loop, name=self.name + '-writer', daemon=True)
+        self._write_thread.start()
+        recv_buf = bytearray(self.RecvSize)
+        view = memoryview(recv_buf)
         while not self._be_quit:
             try:
-                data = self._sock.recv(4096)
+                n = self._sock.recv_into(recv_buf)
             except Exception as e:
-                print(e)
+                logger.debug('%s recv error: %s', self.name, e)
                 break
 
-            if not data:
+            if not n:
+                break
+            if not self._feed(view[:n]):
                 break
 
+        self._on_disconnect()
+        # 关闭发送队列, 等待写线程把剩余的数据发送完
+        self._send_queue.close()
+        self._write_thread.join(self.SendTimeout)
+        self._sock.close()
+        logger.debug('%s----exit', self.name)
+
+    def _write_loop(self):
+        """ 写线程, 批量取出发送队列中的数据写入socket """
+        while True:
+            items = self._send_queue.get_all()
+            if items is None:
+                break
             try:
-                msg = Message.create_msg(data.decode('utf-8'))
+                self._sock.sendall(b''.join(items))
             except Exception as e:
-                print(traceback.format_exc())
-                self._send_receipt(0, False, str(e))
-                if --retry == 0:
-                    self.ready2exit()
-                continue
-            # print('%s recv : %s' % (threading.current_thread(), msg.msg))
+                logger.debug('%s send error: %s', self.name, e)
+                self._send_queue.close()
+                break
+        if not self._be_quit:
+            # 队列因慢速客户端策略被关闭或发送失败, 断开连接
+            self.ready2exit()
+
+    def _on_queue_ready(self):
+        """ 发送队列由空变为非空, 线程模式下写线程通过条件变量唤醒, 无需处理 """
+        pass
+
+    def _feed(self, data) -> bool:
+        """ 将收到的数据交给解码器, 逐条处理解析出的完整消息 """
+        try:
+            frames = self._decoder.feed(data)
+        except ValueError as e:
+            logger.warning('%s frame error: %s', self.name, e)
+            return False
+        for frame in frames:
+            if self._be_quit:
+                break
+            self._process_data(frame)
+        return True
+
+    def _process_data(self, data: bytes):
+        """ 解析收到的数据并分发给对应的处理函数, 线程模式和协程模式共用 """
+        try:
+            binary = BinaryProto.is_binary(data)
+            if binary:
+                msg = Message.create_msg_binary(data)
+            else:
+                msg = Message.create_msg(data.decode('utf-8'))
+            # 登陆前由客户端发来的消息决定之后回复使用的编码
+            if not self._user:
+                self._binary = binary
+        except Exception as e:
+            logger.info('%s bad message: %s', self.name, e)
+            _errors.inc('invalid')
+            self._send_receipt(0, False, str(e))
+            self._retry -= 1
+            if self._retry == 0:
+                self.ready2exit()
+            return
+        # print('%s recv : %s' % (threading.current_thread(), msg.msg))
+        cmd = _CmdNames.get(msg.cmd, str(msg.cmd))
+        ok = False
+        self._receipt_failed = False
+        start = time.perf_counter()
+        try:
             # 没有登陆使用未登录的函数处理消息
             if not self._user:
-                self.__nologin_process(msg)
+                ok = self.__nologin_process(msg)
             else:
-                self.__has_logged_process(msg)
-
-        # 将自己从全局信息类中删除，再断开socket连接
+                ok = self.__has_logged_process(msg)
+        finally:
+            _latency.observe(time.perf_counter() - start, cmd)
+            _requests.inc(cmd)
+            # 登陆密码错误等处理函数正常返回但回复失败的请求也计入
+            if not ok or self._receipt_failed:
+                _errors.inc(cmd)
+
+    def _on_disconnect(self):
+        """ 将自己从全局信息类中删除，再断开socket连接 """
         # 防止先断开连接的时候，其他进程调用本类的send方法发送数据
         if self._user:
             self._global_info.del_connect(self._user.ID)
-        self._sock.close()
-        print('%s----exit' % self.name)
+            # 没有注销直接断开连接时也通知好友下线
+            if self._user.online:
+                self._user.online = False
+                self._notify_friend(False)
 
     @use_log
     def _login_process(self, msg):
@@ -81,28 +190,31 @@ class Transfer(threading.Thread):
         else:
             # 判断用户名和密码
             if self._db.check_user_pwd(msg.ID, msg.pwd):
-                print(msg.ID, '登陆成功')
+                logger.debug('%s 登陆成功', msg.ID)
                 self._user = self._db.query_user(msg.ID)
                 self._global_info.add_connect(msg.ID, self)
                 self._user.online = True
                 self._notify_friend(True)
                 self._send_user_info(msg.cmd)
+                # 有离线消息时主动发送第一页, 之后由客户端确认并请求下一页
+                if self._global_info.pending_offline(msg.ID):
+                    self._send_offline_page(0, self.OfflinePageSize)
                 # 将线程名改为 "用户:ID"
                 self.name = "用户:" + self._user.ID
             else:
                 self._send_user_info(msg.cmd, False, 'id未注册或密码错误')
-                print(msg.ID, msg.pwd, '登陆失败')
+                logger.info('%s 登陆失败', msg.ID)
 
     @use_log
     def _register_process(self, msg):
         """ 处理用户注册 """
         assert type(msg) == RegisterMsg
 
-        print(msg.nick_name, '注册成功')
         # 分配ID, 存储用户, 返回消息
         ID = self._db.distribution_id()
         user = User(ID=ID, nick_name=msg.nick_name)
         self._db.add_user(user, msg.pwd)
+        logger.debug('%s %s 注册成功', ID, msg.nick_name)
         self._send_receipt(msg.cmd, ID=ID)
         # print(user)
 
@@ -157,8 +269,11 @@ class Transfer(threading.Thread):
             else:  # 在DB中未找到用户
                 self._send_receipt(msg.cmd, False, '没有找到id为 %s 的用户', fid)
         else:  # 删除好友
-            if self._user.del_friend4group(msg.friend_id, msg.group):
-                self._db.data_changed()
+            with self._state_l:
+                deleted = self._user.del_friend4group(msg.friend_id, msg.group)
+                if deleted:
+                    self._db.data_changed(self._user)
+            if deleted:
                 self._send_receipt(msg.cmd)
             else:
                 self._send_receipt(msg.cmd, False, '好友或分组不存在')
@@ -170,15 +285,22 @@ class Transfer(threading.Thread):
         assert type(msg) == AcceptDenyReqMsg
 
         if msg.accept:
-            # 查找同意的ID是否在请求列表中
-            req_msg = self._find_save_req_msg(msg)
+            with self._state_l:
+                # 查找同意的ID是否在请求列表中
+                req_msg = self._find_save_req_msg(msg)
+                if req_msg:
+                    # 在_req_friend_ids中的id一定是能被查询到的,在_add_del_friend中已经做过检查
+                    self._user.add_friend2group(msg.friend_id, msg.group)
+                    self._db.data_changed(self._user)
+                    self._remove_req_msg(msg)
             if not req_msg:
                 self._send_receipt(msg.cmd, False, str('%s 的用户没有添加您或消息已过期' % msg.friend_id))
                 return
-            # 在_req_friend_ids中的id一定是能被查询到的,在_add_del_friend中已经做过检查
-            self._user.add_friend2group(msg.friend_id, msg.group)
             self._send_receipt(msg.cmd)
-            self._remove_req_msg(msg)
+        elif not self._find_save_req_msg(msg) and not self._db.query_user(msg.friend_id):
+            # 拒绝时也要确认对方存在, 否则会为任意ID保存离线消息
+            self._send_receipt(msg.cmd, False, str('%s 的用户不存在' % msg.friend_id))
+            return
 
         # 如果拒绝添加，直接转发
         msg.group = None
@@ -211,14 +333,14 @@ class Transfer(threading.Thread):
         users = []  # 防止id和nick都为None时出现users没定义的异常
         if msg.friend_id:
             # 按ID查询
-            users = self._db.find_user4id(msg.friend_id, msg.fuzzy)
+            users = self._db.find_user4id(msg.friend_id, msg.fuzzy, limit=self.FindLimit, findable=True)
         elif msg.nick_name:
             # 按昵称查询
-            users = self._db.find_user4nickname(msg.nick_name, msg.fuzzy)
+            users = self._db.find_user4nickname(msg.nick_name, msg.fuzzy, limit=self.FindLimit, findable=True)
 
+        # 数据库只返回允许被查找的用户, 不允许的用户不会占用FindLimit
         for user in users:
-            if user.allow_find:  # 用户允许被查找则添加到结果中
-                ret_msg.result.append(user.simple_info())
+            ret_msg.result.append(user.simple_info())
         self.send(ret_msg)
 
     @use_log
@@ -227,15 +349,14 @@ class Transfer(threading.Thread):
         msg = kwargs.get('msg')
         assert type(msg) == SetInfoMsg
 
-        self._user.nick_name = msg.nick_name
-        self._user.sex = msg.sex
-        self._user.birthday = msg.birthday
-        self._user.desc = msg.desc
-        self._user.ext_info = msg.ext_info
-        self._user.allow_find = msg.allow_find
-
+        self._db.update_user_profile(self._user,
+                                     nick_name=msg.nick_name,
+                                     sex=msg.sex,
+                                     birthday=msg.birthday,
+                                     desc=msg.desc,
+                                     ext_info=msg.ext_info,
+                                     allow_find=msg.allow_find)
         self._send_receipt(msg.cmd, True, 'success')
-        self._db.data_changed()
 
     @use_log
     def _modify_password_msg(self, **kwargs):
@@ -254,16 +375,18 @@ class Transfer(threading.Thread):
         assert type(msg) == AddDelGroupMsg
 
         reason = None
-        if msg.add:
-            if not self._user.add_group(msg.group):
-                reason = '分组已存在'
-        else:
-            if not self._user.del_group(msg.group, msg.moveto):
-                reason = '分组不存在'
+        with self._state_l:
+            if msg.add:
+                if not self._user.add_group(msg.group):
+                    reason = '分组已存在'
+            else:
+                if not self._user.del_group(msg.group, msg.moveto):
+                    reason = '分组不存在'
+            if not reason:
+                self._db.data_changed(self._user)
         if reason:
             self._send_receipt(msg.cmd, False, reason)
         else:
-            self._db.data_changed()
             self._send_receipt(msg.cmd)
 
     @use_log
@@ -272,18 +395,32 @@ class Transfer(threading.Thread):
         assert type(msg) == ReqUserInfoMsg
         self._send_user_info(msg.cmd)
 
-    def _notify_friend(self, online: bool):
-        """ 通知好友上线/通知好友下线 """
-        msg = RetOnlineNotifyMsg(RetOnlineNotifyMsg.DefaultMsg)
-        # 此处是自己的ID，告诉朋友自己上线了
-        msg.friend_id = self._user.ID
-        msg.nick_name = self._user.nick_name
-        msg.online = online
+    @use_log
+    def _sync_offline_msg(self, **kwargs):
+        """ 离线消息同步, 确认游标之前的消息, 返回下一页 """
+        msg = kwargs.get('msg')
+        assert type(msg) == SyncOfflineMsg
 
-        # 遍历好友列表，逐个通知好友
-        for flist in self._user.groups.values():
-            for friend_id in flist:
-                self._global_info.send_msg2id(friend_id, msg)
+        self._global_info.ack_offline(self._user.ID, msg.cursor)
+        # limit为0时只确认不再请求
+        if msg.limit > 0:
+            self._send_offline_page(msg.cursor, msg.limit)
+        else:
+            self._send_receipt(msg.cmd)
+
+    def _send_offline_page(self, cursor: int, limit: int):
+        """ 将一页离线消息打包成一条消息发送 """
+        msgs, cursor, remain = self._global_info.read_offline(
+            self._user.ID, cursor, min(limit, self.OfflinePageSize))
+        ret_msg = RetOfflineMsg(RetOfflineMsg.DefaultMsg)
+        ret_msg.cursor = cursor
+        ret_msg.remain = remain
+        ret_msg.result = [m.msg_dict for m in msgs if self._apply_notify(m)]
+        self.send(ret_msg)
+
+    def _notify_friend(self, online: bool):
+        """ 通知好友上线/通知好友下线, 由Presence合并后批量发送 """
+        self._presence.changed(self._user, online)
 
     def __nologin_process(self, msg: Message) -> bool:
         """ 用户未登陆时的消息处理 """
@@ -308,11 +445,11 @@ class Transfer(threading.Thread):
                 ret = True
             except AssertionError:
                 # 断言错误, 一般不可能产生这种错误, 因为消息是按照命令来解析的
-                print(traceback.format_exc())
+                logger.exception('%s message format error', self.name)
                 self.ready2exit()
                 self._send_receipt(msg.cmd, False, 'message format error')
             except Exception as e:
-                print(traceback.format_exc())
+                logger.exception('%s handle cmd %s error', self.name, msg.cmd)
                 self._send_receipt(msg.cmd, False, str(e))
         return ret
 
@@ -324,17 +461,26 @@ class Transfer(threading.Thread):
         msg.reason = reason
         if succ:
             msg.user = self._user.__dict__()
-            for key, group in self._user.groups.items():
-                for friend_id in group:
-                    friend = self._db.query_user(friend_id)
-                    if friend:
-                        msg.user['groups'][key] = friend.simple_info()
+            # 一次查询所有好友, 按分组生成好友摘要列表, 不修改用户自己的分组
+            friends = self._db.query_users(list(self._user.friend_ids()))
+            msg.user['groups'] = {key: [self._friend_summary(friends[friend_id])
+                                        for friend_id in group if friend_id in friends]
+                                  for key, group in self._user.groups.items()}
         else:
+            self._receipt_failed = True
             msg.user = {}
         self.send(msg)
 
+    def _friend_summary(self, friend) -> dict:
+        """ 好友摘要, 在线状态以连接表为准 """
+        info = friend.simple_info()
+        info['online'] = self._global_info.is_login(friend.ID)
+        return info
+
     def _send_receipt(self, exec_cmd, succ=True, reason='success', ID='0'):
         """ 发送消息回执 """
+        if not succ:
+            self._receipt_failed = True
         msg = ReceiptMsg(ReceiptMsg.DefaultMsg)
         msg.success = succ
         msg.reason = reason
@@ -344,61 +490,79 @@ class Transfer(threading.Thread):
 
     def _save_req_friend_msg(self, msg: Message):
         """ 将请求加好友的ID存储起来 """
-        self._req_friend_msg.append(msg)
-        # 最多保存100个请求
-        if len(self._req_friend_msg) > 50:
-            del self._req_friend_msg[0]
+        with self._state_l:
+            # 未确认的离线消息会被再次读取, 相同的请求不重复保存
+            if any(m.msg_dict == msg.msg_dict for m in self._req_friend_msg):
+                return
+            self._req_friend_msg.append(msg)
+            # 最多保存100个请求
+            if len(self._req_friend_msg) > 50:
+                del self._req_friend_msg[0]
 
     def _find_save_req_msg(self, msg: Message):
-        for m in self._req_friend_msg:
-            if m.friend_id == msg.friend_id:
-                return m
+        with self._state_l:
+            for m in self._req_friend_msg:
+                if m.friend_id == msg.friend_id:
+                    return m
         return None
 
     def _remove_req_msg(self, msg: Message):
-        reserved_msg = []
-        # 可能有多个相同的好友请求,所以需要全部遍历
-        for m in self._req_friend_msg:
-            if m.friend_id != msg.friend_id:
-                reserved_msg.append(m)
-        self._req_friend_msg = reserved_msg
+        with self._state_l:
+            reserved_msg = []
+            # 可能有多个相同的好友请求,所以需要全部遍历
+            for m in self._req_friend_msg:
+                if m.friend_id != msg.friend_id:
+                    reserved_msg.append(m)
+            self._req_friend_msg = reserved_msg
 
 
     def ready2exit(self):
         """ 准备退出 """
         self._be_quit = True
-        self._sock.shutdown(socket.SHUT_RD)
+        # 接收方太慢被断开时, 剩余数据不再发送, 同时关闭写端让写线程退出
+        how = self._send_queue.overflow and socket.SHUT_RDWR or socket.SHUT_RD
+        try:
+            self._sock.shutdown(how)
+        except OSError:
+            # socket已经关闭
+            pass
 
     def send(self, msg: Message):
-        """ 消息发送函数 """
-        self._sock.send(msg.msg_crypto_bytes)
+        """ 消息发送函数, 只放入发送队列, 不阻塞调用者 """
+        if not self._send_queue.put(msg.frame_bytes(self._decoder, self._binary)):
+            if self._send_queue.closed and not self._be_quit:
+                self.ready2exit()
 
     def recv_notify(self, msg: Message) -> bool:
-        """ 接受其他用户发来的消息 """
+        """ 接受其他用户发来的消息, 在发送方的线程中调用, 只有放入发送队列不加锁 """
+        if self._apply_notify(msg):
+            self.send(msg)
+            return True
+        return False
+
+    def _apply_notify(self, msg: Message) -> bool:
+        """ 处理其他用户发来的消息对自己的影响, 返回是否需要转发给自己的客户端 """
 
         # 请求添加好友的消息
         if type(msg) == AddDelFriendMsg:
             # 保存请求添加好友的ID,在将消息转发给自己的客户端
             self._save_req_friend_msg(msg)
-            self.send(msg)
             return True
 
         # 好友同意或拒绝添加自己
         if type(msg) == AcceptDenyReqMsg:
-            if msg.accept:
-                # 由于只有自己的请求中才含有分组信息，所以需要将自己发送的请求消息拿出来
-                req_msg = self._find_save_req_msg(msg)
-                self._user.add_friend2group(msg.friend_id, req_msg.group)
-            self._remove_req_msg(msg)
-            self.send(msg)
-
-        if type(msg) == RetOnlineNotifyMsg:
-            self.send(msg)
+            with self._state_l:
+                if msg.accept:
+                    # 由于只有自己的请求中才含有分组信息，所以需要将自己发送的请求消息拿出来
+                    # 离线期间收到的同意消息, 请求可能已经不在本次连接中, 放入默认分组
+                    req_msg = self._find_save_req_msg(msg)
+                    # 离线消息可能被重复读取, 已经是好友时不再修改
+                    if self._user.add_friend2group(msg.friend_id, req_msg and req_msg.group or 'friends'):
+                        self._db.data_changed(self._user)
+                self._remove_req_msg(msg)
             return True
 
-        if type(msg) == ChatMsg:
-            self.send(msg)
-            return True
+        return type(msg) == RetOnlineNotifyMsg or type(msg) == ChatMsg
 
     def ID(self):
         return self.name
\ No newline at end of file
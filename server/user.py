@@ -1,4 +1,10 @@
 class Storable(object):
+    # 类名到类的映射, 反序列化时按序列化保存的类名查找
+    _registry = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Storable._registry[cls.__name__] = cls
 
     def __init__(self, **kwargs):
         """ 使用字典反序列化 """
@@ -56,11 +62,19 @@ class Storable(object):
     @staticmethod
     def decode(obj):
         """ json反序列化方法，Storable类再序列化的时候会将 class 名字存储起来 """
-        """ 反序列化时，通过eval动态创建对象 """
-        if 'class' in obj:
-            cls = obj['class']+'(**obj)'
-            return eval(cls)
-        return obj
+        """
+            反序列化时，按类名在注册表中查找类并由字典构造, 未注册的类名保持字典不变
+            只用于数据库记录本身, 不能作为object_hook作用于所有嵌套的字典, 否则客户端数据也会被构造成对象
+        """
+        cls = Storable._registry.get(obj.get('class'))
+        if cls is None:
+            return obj
+        return cls.from_dict(obj)
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        """ 由序列化的字典构造对象, 子类可以重写以加快加载 """
+        return cls(**d)
 
 
 class User(Storable):
@@ -84,50 +98,82 @@ class User(Storable):
     """
     __slots__ = ['ID', 'nick_name', 'sex', 'birthday',
                  'desc', 'allow_find', 'online', 'groups',
-                 'ext_info']
+                 'ext_info', '_friend_map']
 
     __DefaultGroup = 'friends'
+    # 用户可以自己修改的资料字段
+    ProfileKeys = ('nick_name', 'sex', 'birthday', 'desc', 'allow_find', 'ext_info')
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self._init_state()
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        """ 加载数据库时直接由字典构造, 不经过逐个属性的通用反序列化 """
+        get = d.get
+        user = cls.__new__(cls)
+        user.ID = get('ID')
+        user.nick_name = get('nick_name')
+        user.sex = get('sex')
+        user.birthday = get('birthday')
+        user.desc = get('desc')
+        user.allow_find = get('allow_find')
+        user.groups = get('groups')
+        user.ext_info = get('ext_info')
+        user._init_state()
+        return user
+
+    def _init_state(self):
+        """ 初始化不需要序列化的状态 """
         if not self.groups:
             self.groups = {self.__DefaultGroup: []}
         self.online = False
+        # 好友ID到分组的反向索引, 只在内存中维护, 不会被序列化
+        self._friend_map = {}
+        for group, friends in self.groups.items():
+            for friend_id in friends:
+                self._friend_map[friend_id] = group
 
     def has_friend(self, ID: str) -> (bool, str):
-        """ 查找好友 """
-        for group, friend_set in self.groups.values():
-            if ID in friend_set:
-                return True, group
-        return False, None
+        """ 查找好友, 返回是否为好友和所在分组 """
+        group = self._friend_map.get(ID)
+        return group is not None, group
+
+    def friend_ids(self):
+        """ 所有好友的ID """
+        return self._friend_map.keys()
 
     def add_friend2group(self, friend_id, group: str) -> bool:
         """ 添加一个好友到分组 """
-        if self.has_friend(friend_id)[0]:
+        if friend_id in self._friend_map:
             # 找到好友直接返回
             return False
         # 没找到，向group中里面添加一个好友
         self.add_group(group)
         self.groups[group].append(friend_id)
+        self._friend_map[friend_id] = group
         return True
 
-    def del_friend4group(self, friend_id) -> bool:
-        """ 从一个分组删除一个好友 """
-        has_friend, group = self.has_friend(friend_id)
-        if has_friend:
-            self.groups[group].remove(friend_id)
-            return True
-        return False
+    def del_friend4group(self, friend_id, group: str=None) -> bool:
+        """ 从分组删除一个好友, 指定分组时好友必须在该分组中 """
+        old_g = self._friend_map.get(friend_id)
+        if old_g is None or (group and group != old_g):
+            return False
+        self.groups[old_g].remove(friend_id)
+        del self._friend_map[friend_id]
+        return True
 
     def move_friend2group(self, friend, old_g, new_g):
         if old_g == new_g:
             return False
-        if friend not in self.groups[old_g]:
+        if self._friend_map.get(friend) != old_g:
             return False
         if self.groups.get(new_g):
             return False
         self.groups[old_g].remove(friend)
         self.groups[new_g].append(friend)
+        self._friend_map[friend] = new_g
 
     def add_group(self, group: str) -> bool:
         """ 添加一个分组 """
@@ -143,6 +189,8 @@ class User(Storable):
         if not self.groups.get(new_group):
             return False
         # 将原分组的好友移动到新分组
+        for friend_id in self.groups[group]:
+            self._friend_map[friend_id] = new_group
         self.groups[new_group].extend(self.groups[group])
         del self.groups[group]
         return True
@@ -163,7 +211,15 @@ class User(Storable):
 
     @staticmethod
     def __exclude_storage__() -> tuple:
-        return ('online',)
+        return ('online', '_friend_map')
+
+    @staticmethod
+    def __exclude_dict__():
+        return ('_friend_map',)
+
+    @staticmethod
+    def __exclude_str__() -> tuple:
+        return ('_friend_map',)
 
     def __eq__(self, other):
         return self.ID == other.ID
@@ -1,15 +1,23 @@
+import logging
 import re
 from functools import wraps
+from log import get_logger
 
 __all__ = ['Check', 'use_log']
 
 
 def use_log(func):
+    """ 在DEBUG级别记录函数的进入和退出, 没有开启DEBUG时只多一次级别判断 """
+    logger = get_logger(func.__module__)
+    name = func.__qualname__
+
     @wraps(func)
     def inner(*args, **kwargs):
-        print('+++++++++++%s+++++++++++++' % func.__name__)
+        if not logger.isEnabledFor(logging.DEBUG):
+            return func(*args, **kwargs)
+        logger.debug('+++++++++++%s+++++++++++++', name)
         ret = func(*args, **kwargs)
-        print('-----------%s-------------' % func.__name__)
+        logger.debug('-----------%s-------------', name)
         return ret
     return inner
 
@@ -0,0 +1,71 @@
+from log import get_logger
+import codec
+import os
+import shutil
+
+__all__ = ['WriteAheadLog']
+
+logger = get_logger('wal')
+
+
+class WriteAheadLog(object):
+    """
+        预写日志, 每次数据修改追加一行JSON记录
+        开始快照时切换到新日志, 快照写入磁盘后删除旧日志
+        启动时先加载快照再依次重放旧日志和新日志
+        本类不加锁, 由调用者保证互斥
+    """
+    def __init__(self, path: str, fsync=False):
+        self._path = path
+        self._fsync = fsync
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def append(self, record: dict, fsync=False):
+        """ 追加一条记录, 写入操作系统后返回, fsync为True时这条记录写入磁盘后才返回 """
+        self._file.write(codec.dumps(record))
+        self._file.write('\n')
+        self._file.flush()
+        if self._fsync or fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """ 开始快照, 之前的记录移到.old文件, 之后的记录写入新日志 """
+        self._file.close()
+        old = self._path + '.old'
+        if os.path.exists(old):
+            # 上次快照没有完成, 合并到.old中
+            with open(old, 'a+b') as dst, open(self._path, 'rb') as src:
+                # .old的最后一行可能没有写完, 另起一行避免和后面的记录连在一起
+                if dst.tell():
+                    dst.seek(dst.tell() - 1)
+                    if dst.read(1) != b'\n':
+                        dst.write(b'\n')
+                shutil.copyfileobj(src, dst)
+            os.remove(self._path)
+        else:
+            os.replace(self._path, old)
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    def drop_rotated(self):
+        """ 快照已经写入磁盘, 删除旧日志 """
+        old = self._path + '.old'
+        if os.path.exists(old):
+            os.remove(old)
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def replay(path: str, obj_hook=None):
+        """ 按顺序返回旧日志和新日志中的记录, 忽略崩溃时没有写完的行 """
+        for name in (path + '.old', path):
+            if not os.path.exists(name):
+                continue
+            with open(name, encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        yield codec.loads(line, obj_hook)
+                    except ValueError as e:
+                        logger.warning('%s: skip bad record: %s', name, e)